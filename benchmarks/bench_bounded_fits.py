@@ -0,0 +1,71 @@
+"""
+Check of the bounded Levenberg-Marquardt fits against trf on the Duan et al
+yeast sample.
+
+The sample is downsampled to 40 kb, normalized and its intra chromosomal
+counts are masked, as in the search of centromeres_calls. Every
+combination of the first two candidates of each chromosome is fitted, at
+sigma 2 and 4, by fit_gaussian_batch and by fit_gaussian with the
+structured and trf solvers. Reports the objective reached from each start
+by each of them, and the convergence code of the bounded Levenberg-Marquardt
+fits: 1 to 4 when they converged, -2 when they ended with no gaussian or
+with every position on a chromosome end. Fits from the same start can
+reach different local minima: the lowest objective of each column should
+match.
+"""
+from __future__ import print_function
+import itertools
+import time
+import numpy as np
+from centurion.externals import iced
+from centurion import prelocalization_
+from centurion import utils
+from centurion.optimization import fit_gaussian, fit_gaussian_batch
+from centurion.optimization import FitProblem
+
+
+if __name__ == "__main__":
+    counts, lengths = iced.datasets.load_sample_yeast()
+    counts, lengths = utils.downsample_resolution(counts, lengths,
+                                                  coefficient=4)
+    counts = iced.normalization.ICE_normalization(counts)
+    utils.mask_intra_counts(counts, lengths)
+
+    candidates = prelocalization_.find_centromeres_candidates(
+        counts, lengths, n_candidate=2)
+    starts = list(itertools.product(*[c[:2] for c in candidates]))
+    problem = FitProblem(counts, lengths)
+
+    for sigma in [2, 4]:
+        inits = np.array([problem.initial_parameters(start, sigma)
+                          for start in starts])
+        t0 = time.time()
+        _, batch_fvals, _, ier = fit_gaussian_batch(
+            counts, inits, lengths, problem=problem)
+        batch_time = time.time() - t0
+
+        fvals, codes, times = {}, {}, {}
+        for solver in ["structured", "trf"]:
+            t0 = time.time()
+            fvals[solver], codes[solver] = [], []
+            for init in inits:
+                results, _, _, _, code = fit_gaussian(
+                    counts, init, lengths, problem=problem, solver=solver)
+                fvals[solver].append(problem.objective(results))
+                codes[solver].append(code)
+            times[solver] = time.time() - t0
+
+        print("sigma %d" % sigma)
+        print("%-26s %13s %4s %13s %4s %13s" % (
+            "start", "batch", "ier", "structured", "ier", "trf"))
+        for i, start in enumerate(starts):
+            print("%-26s %13.6e %4d %13.6e %4d %13.6e" % (
+                " ".join("%.1f" % s for s in start), batch_fvals[i], ier[i],
+                fvals["structured"][i], codes["structured"][i],
+                fvals["trf"][i]))
+        print("%-26s %13.6e %4s %13.6e %4s %13.6e" % (
+            "lowest", batch_fvals.min(), "", min(fvals["structured"]), "",
+            min(fvals["trf"])))
+        print("%-26s %12.2fs %4s %12.2fs %4s %12.2fs" % (
+            "time", batch_time, "", times["structured"], "", times["trf"]))
+        print()
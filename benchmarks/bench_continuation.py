@@ -0,0 +1,44 @@
+"""
+Benchmark of the sigma continuation of refine_centromeres on the Duan et al
+yeast sample.
+
+Every combination of the first two candidates of each chromosome is refined
+directly from sigma=4, and by continuation from wider sigmas. Reports the
+number of evaluations of each stage, summed over the candidates, and the
+best and median objective values reached.
+"""
+from __future__ import print_function
+import itertools
+import time
+import numpy as np
+from centurion.externals import iced
+from centurion import prelocalization_
+from centurion.optimization import FitProblem
+
+
+if __name__ == "__main__":
+    counts, lengths = iced.datasets.load_sample_yeast()
+    counts = iced.normalization.ICE_normalization(counts)
+    candidates = prelocalization_.find_centromeres_candidates(
+        counts, lengths, n_candidate=2)
+    counts[iced.utils.get_intra_mask(lengths)] = 0
+    candidates = list(itertools.product(*[c[:2] for c in candidates]))
+    problem = FitProblem(counts, lengths)
+
+    print("%-12s %-24s %10s %14s %14s" % (
+        "schedule", "evaluations per stage", "time", "best", "median"))
+    for schedule in [None, [8], [16, 8], [24, 12, 8]]:
+        n_evaluations, objective = [], []
+        t0 = time.time()
+        for candidate in candidates:
+            fval, _, n_eval = prelocalization_.refine_centromeres(
+                counts, lengths, candidate, problem=problem,
+                sigma_schedule=schedule, return_n_evaluations=True)
+            n_evaluations.append(n_eval)
+            objective.append(fval)
+        elapsed = time.time() - t0
+        print("%-12s %-24s %9.2fs %14.6e %14.6e" % (
+            "none" if schedule is None else
+            ",".join("%g" % s for s in schedule),
+            " + ".join("%d" % n for n in np.sum(n_evaluations, axis=0)),
+            elapsed, min(objective), np.median(objective)))
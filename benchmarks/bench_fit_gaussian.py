@@ -0,0 +1,59 @@
+"""
+Benchmark of the centromere model fit on the Duan et al yeast sample.
+
+Compares the number of function evaluations and the running time of
+fit_gaussian with the leastsq and trf solvers, each with the analytic
+jacobian and with a forward difference estimate, and with variable
+projection of the amplitude and baseline with the analytic jacobian. Each fit
+is started from every combination of the first two candidates of the first
+and last chromosomes, with at most 2000 evaluations. The "maxfev" column
+counts the fits stopped by that limit.
+
+Note that scipy.optimize.least_squares does not count the evaluations spent
+on forward differences in nfev: for the trf solver with a finite difference
+jacobian, the total number of evaluations is nfev + njev * (L + 3).
+"""
+from __future__ import print_function
+import itertools
+import time
+import numpy as np
+from centurion.externals import iced
+from centurion import prelocalization_
+from centurion.optimization import fit_gaussian, FitProblem
+
+
+if __name__ == "__main__":
+    counts, lengths = iced.datasets.load_sample_yeast()
+    counts = iced.normalization.ICE_normalization(counts)
+    counts[iced.utils.get_intra_mask(lengths)] = 0
+
+    candidates = prelocalization_.find_centromeres_candidates(
+        counts, lengths, n_candidate=2)
+    candidates = [c[:2] if i in (0, len(lengths) - 1) else c[:1]
+                  for i, c in enumerate(candidates)]
+    problem = FitProblem(counts, lengths)
+
+    print("%-8s %-12s %-7s %8s %8s %8s %10s %16s" % (
+        "solver", "jacobian", "varpro", "nfev", "njev", "maxfev", "time",
+        "objective"))
+    settings = [(jacobian, False) for jacobian in (False, True)] + \
+        [(True, True)]
+    for solver, (jacobian, varpro) in itertools.product(["leastsq", "trf"],
+                                                        settings):
+        nfev, njev, n_maxfev, elapsed, objective = 0, 0, 0, 0, []
+        for candidate in itertools.product(*candidates):
+            init = problem.initial_parameters(candidate, 4)
+            t0 = time.time()
+            results, _, infodict, _, ier = fit_gaussian(
+                counts, init, lengths, problem=problem, factor=10,
+                jacobian=jacobian, solver=solver, maxfev=2000,
+                variable_projection=varpro)
+            elapsed += time.time() - t0
+            nfev += infodict["nfev"]
+            njev += infodict.get("njev", 0)
+            n_maxfev += ier == 5
+            objective.append(problem.objective(results))
+        print("%-8s %-12s %-7s %8d %8d %8d %9.2fs %16.6e" % (
+            solver, "analytic" if jacobian else "finite diff.",
+            "yes" if varpro else "no", nfev, njev, n_maxfev, elapsed,
+            min(objective)))
@@ -0,0 +1,62 @@
+"""
+Benchmark of the peak memory of centromeres calling, in multiples of the size
+of the contact count matrix.
+
+A random symmetric contact count matrix of 2000 bins and 4 chromosomes,
+about 5% non zero, with a gaussian centromere signal, is called at 10 kb
+from known initial positions (the refinement at full resolution only), and
+the candidates are searched, filtered and refined by centromeres_calls_.
+The peak memory is measured with tracemalloc, to which numpy reports its
+arrays: this benchmark requires Python 3.
+"""
+from __future__ import print_function
+import time
+import tracemalloc
+import numpy as np
+from centurion.centromeres_calls import centromeres_calls
+from centurion.centromeres_calls import centromeres_calls_
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    t0 = time.time()
+    func()
+    elapsed = time.time() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+if __name__ == "__main__":
+    random_state = np.random.RandomState(0)
+    lengths = np.array([600, 500, 500, 400])
+    n = lengths.sum()
+    begin = np.concatenate([[0], lengths.cumsum()[:-1]])
+    centromeres = begin + lengths / 3.
+    bins = np.repeat(np.arange(len(lengths)), lengths)
+    signal = np.exp(- (centromeres[bins] - np.arange(n)) ** 2 / (2 * 4 ** 2))
+    counts = random_state.poisson(0.05 + 5 * np.outer(signal, signal))
+    counts = np.triu(counts, 1)
+    counts = (counts + counts.T).astype(float)
+    init = (centromeres - begin) * 10000.
+    # Overwritten by the copy=False run
+    working_counts = counts.copy()
+
+    runs = [
+        ("centromeres_calls_", lambda: centromeres_calls_(
+            counts, lengths, sigma=4, n_candidate=2, verbose=0,
+            filter_candidates=True, max_trials=0)),
+        ("refinement, ICE", lambda: centromeres_calls(
+            counts, lengths, resolution=10000, init=init.copy())),
+        ("refinement, raw", lambda: centromeres_calls(
+            counts, lengths, resolution=10000, init=init.copy(),
+            normalize=False)),
+        ("refinement, raw, copy=False", lambda: centromeres_calls(
+            working_counts, lengths, resolution=10000, init=init.copy(),
+            normalize=False, copy=False)),
+    ]
+    print("%-30s %12s %12s %10s" % ("run", "peak", "x counts", "time"))
+    for name, func in runs:
+        peak, elapsed = peak_memory(func)
+        print("%-30s %10.1fMB %12.2f %9.2fs" % (
+            name, peak / 2. ** 20, peak / float(counts.nbytes), elapsed))
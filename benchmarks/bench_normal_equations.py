@@ -0,0 +1,46 @@
+"""
+Benchmark of the cost of one Gauss-Newton iteration with the number of
+chromosomes.
+
+A random contact count matrix of 2000 bins, with 10% of non zero entries,
+is split in an increasing number of chromosomes. Compares the time to build
+the normal equations from the full jacobian (as the leastsq and trf solvers
+do) and with FitProblem.normal_equations, which uses the chromosome
+structure of the jacobian.
+"""
+from __future__ import print_function
+import time
+import numpy as np
+from scipy import sparse
+from centurion.optimization import FitProblem
+
+
+def timeit(func, n_repeat=5):
+    t0 = time.time()
+    for _ in range(n_repeat):
+        func()
+    return (time.time() - t0) / n_repeat
+
+
+if __name__ == "__main__":
+    random_state = np.random.RandomState(0)
+    n = 2000
+    counts = sparse.random(n, n, density=0.05, random_state=random_state)
+    counts = (counts + counts.T).toarray()
+
+    print("%6s %16s %16s" % ("L", "jacobian", "structured"))
+    for n_chromosomes in [4, 8, 16, 32, 64, 128]:
+        lengths = np.full(n_chromosomes, n // n_chromosomes)
+        lengths[-1] += n - lengths.sum()
+        problem = FitProblem(counts, lengths)
+        x = problem.initial_parameters(
+            np.cumsum(lengths) - lengths / 2., 4)
+
+        def full():
+            jacobian = problem.jacobian(x, out=problem.jacobian_buffer)
+            return (np.dot(jacobian, jacobian.T),
+                    np.dot(jacobian, problem.residuals(x)))
+
+        print("%6d %15.4fs %15.4fs" % (
+            n_chromosomes, timeit(full),
+            timeit(lambda: problem.normal_equations(x))))
@@ -0,0 +1,52 @@
+"""
+Benchmark of the runtime of centromeres_calls with the resolution of the
+contact counts.
+
+A random symmetric contact count matrix of a 12 Mb genome of 8 chromosomes,
+with a gaussian centromere signal of 80 kb, is drawn at 2 kb, and called at
+20, 10, 4 and 2 kb. The counts follow the model of the fits, and aren't
+normalized. The centromeres are called with the default pyramid
+(a search at 40 kb and a refinement on the whole genome at the resolution of
+the counts), and with the "auto" pyramid refined within 160 kb of the calls
+of each previous resolution. Reports the time of each call and its largest
+error, in kb.
+"""
+from __future__ import print_function
+import time
+import numpy as np
+from centurion import utils
+from centurion.centromeres_calls import centromeres_calls
+
+
+if __name__ == "__main__":
+    random_state = np.random.RandomState(0)
+    lengths = np.array([1000, 900, 800, 800, 700, 700, 600, 500])
+    n = lengths.sum()
+    begin = np.concatenate([[0], lengths.cumsum()[:-1]])
+    centromeres = (random_state.uniform(0.2, 0.8, len(lengths)) *
+                   lengths).astype(int)
+    bins = np.repeat(np.arange(len(lengths)), lengths)
+    signal = np.exp(- (begin[bins] + centromeres[bins] - np.arange(n)) ** 2 /
+                    (2 * 40. ** 2))
+    counts = random_state.poisson(0.05 + 2 * np.outer(signal, signal))
+    counts = np.triu(counts, 1)
+    counts = (counts + counts.T).astype(float)
+    del signal
+
+    print("%10s %-24s %10s %10s" % ("resolution", "pyramid", "time",
+                                    "error"))
+    for resolution in [20000, 10000, 4000, 2000]:
+        counts_r, lengths_r = utils.downsample_resolution(
+            counts, lengths, coefficient=resolution // 2000)
+        for name, options in [
+                ("40kb, whole genome", {}),
+                ("auto, window=160kb",
+                 dict(resolutions="auto", window=160000))]:
+            t0 = time.time()
+            calls = centromeres_calls(counts_r, lengths_r,
+                                      resolution=resolution, normalize=False,
+                                      **options)
+            elapsed = time.time() - t0
+            error = np.abs(calls / 1000. - 2 * centromeres).max()
+            print("%8dkb %-24s %9.2fs %9.1fkb" % (
+                resolution // 1000, name, elapsed, error))
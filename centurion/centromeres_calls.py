@@ -7,76 +7,206 @@ from .externals import iced
 def centromeres_calls(counts, lengths, resolution=40000, init=None,
                       n_candidate=3,
                       sigma=None, verbose=0, filter_candidates=True,
-                      normalize=True):
+                      normalize=True, cache=None, copy=True,
+                      resolutions=None, window=None):
     """
     Calls centromeres
 
+    The candidates are searched at the coarsest resolution of the pyramid,
+    and the calls are then refined at each finer resolution, down to the
+    resolution of counts. Each resolution owns a single working buffer, the
+    masked and normalized float counts, which all the stages share without
+    copying it.
+
     Parameters
-    """
-    if sigma is None:
-        sigma = 80000 / resolution
+    ----------
+    sigma : float, optional, default: None
+        initialization of the sigma parameters of the gaussians of the
+        search, in bins of the coarsest resolution of the pyramid. If None,
+        80000 / resolution when the coarsest resolution is 40 kb, and scaled
+        to the coarsest resolution otherwise.
+
+    cache : string or FitCache, optional, default: None
+        If provided, the fits of the candidates are stored in this on-disk
+        cache, and reused by the next calls on the same data. See
+        prelocalization_.optimize_centromeres.
 
-    coef = 40000 / resolution
+    copy : boolean, optional, default: True
+        whether to leave counts unmodified. If False, counts may be
+        overwritten by the working buffer, saving a copy of the matrix when
+        normalize is False and counts is already a float array.
 
+    resolutions : list of integers or "auto", optional, default: None
+        resolutions of the pyramid coarser than resolution, in bp, each a
+        multiple of resolution. If None, the pyramid only has 40 kb. If
+        "auto", 40 kb is divided by 4 at each level, down to resolution, and
+        window defaults to 240 kb. With init, the search is skipped and init
+        is refined at every resolution of the pyramid but the coarsest one.
+
+    window : integer, optional, default: None
+        If provided, each resolution only refines the calls of the previous
+        one within window bp on each side, which should cover the centromere
+        signal. The counts are then normalized once, at the resolution of
+        counts, and each fit only downsamples and reads the counts of these
+        windows. Otherwise, each resolution downsamples, normalizes and
+        refines the calls on the whole genome. Defaults to 240 kb if
+        resolutions is "auto".
+    """
+    levels = _resolution_pyramid(resolution, resolutions)
+    if window is None and isinstance(resolutions, str):
+        # Refining the whole genome at every level of the automatic pyramid
+        # would cost more than fitting it once at resolution: three times
+        # the 80 kb signal around each call is enough
+        window = 240000
+    if sigma is None:
+        sigma = 80000. / resolution * 40000. / levels[0]
     if init is None:
-        counts_40kb, lengths_40kb = utils.downsample_resolution(
+        level = levels.pop(0)
+        coef = level // resolution
+        counts_level, lengths_level = utils.downsample_resolution(
             counts, lengths, coefficient=coef)
+        # The downsampled counts are a new array, except at the resolution
+        # of counts
+        counts_level = _working_buffer(counts_level, lengths_level,
+                                       normalize=normalize,
+                                       copy=copy and coef == 1)
+
+        centromeres_calls = centromeres_calls_(
+            counts_level, lengths_level, sigma=sigma, verbose=verbose,
+            filter_candidates=filter_candidates, copy=False, cache=cache)
+        centromeres_calls[1:] -= lengths_level[:-1].cumsum()
+        centromeres_calls *= level
+    else:
+        centromeres_calls = np.array(init, dtype=float)
+        levels = levels[1:] or levels
+
+    if window is not None and levels:
+        # Normalizing the windows on their own would flatten the centromere
+        # signal, which spans most of their bins
+        counts = _working_buffer(counts, lengths, normalize=normalize,
+                                 copy=copy)
+        normalize = copy = False
+
+    for level in levels:
+        if verbose:
+            print("Refining centromeres calls at %d bp" % level)
+        centromeres_calls = _refine_calls(
+            counts, lengths, centromeres_calls, resolution, level,
+            window=window, normalize=normalize, copy=copy, verbose=verbose,
+            cache=cache)
+    return np.round(centromeres_calls).astype(int)
+
 
-        if normalize:
-            counts_40kb = iced.normalization.ICE_normalization(counts_40kb)
+def _resolution_pyramid(resolution, resolutions=None):
+    """
+    Returns the resolutions of the pyramid, decreasing down to resolution
+    """
+    if resolutions is None or isinstance(resolutions, str):
+        if resolutions not in (None, "auto"):
+            raise ValueError("Unknown resolutions %s" % resolutions)
+        levels, level = [], 40000.
+        while level >= resolution:
+            levels.append(resolution * max(1, int(level // resolution)))
+            if resolutions is None:
+                break
+            level /= 4
+    else:
+        levels = list(resolutions)
+        if any(level % resolution for level in levels):
+            raise ValueError("The resolutions of the pyramid should be "
+                             "multiples of resolution %d" % resolution)
+    levels = sorted(set(level for level in levels if level > resolution),
+                    reverse=True)
+    return levels + [resolution]
 
-        centromeres_calls_40kb = centromeres_calls_(
-            counts_40kb, lengths_40kb, sigma=sigma, verbose=verbose,
-            filter_candidates=filter_candidates)
 
-        candidates = []
-        for i, candidate in enumerate(centromeres_calls_40kb):
-            candidates.append(
-                [(candidate - lengths_40kb[:i].sum()) * coef +
-                 lengths[:i].sum()])
+def _refine_calls(counts, lengths, centromeres_calls, resolution, level,
+                  window=None, normalize=True, copy=True, verbose=0,
+                  cache=None):
+    """
+    Refines the calls, in bp from the start of each chromosome, on counts
+    downsampled to level
 
+    If window is provided, only the bins within window bp of the calls are
+    downsampled, normalized and fitted, and the calls can't leave them.
+    """
+    coef = level // resolution
+    if window is None:
+        begin = 0
+        counts, lengths = utils.downsample_resolution(
+            counts, lengths, coefficient=coef)
+        copy = copy and coef == 1
     else:
-        init /= resolution
-        if len(init) > 1:
-            init[1:] += lengths[:-1].cumsum()
-        candidates = [[i] for i in init]
+        lengths = np.asarray(lengths).astype(int)
+        n_bins = -(-lengths // coef)
+        start = np.clip(np.floor((centromeres_calls - window) / level),
+                        0, n_bins - 1).astype(int)
+        end = np.clip(np.ceil((centromeres_calls + window) / level) + 1,
+                      start + 1, n_bins).astype(int)
+        # The windows start on a bin of level, so that downsampling them
+        # gives the bins of the whole downsampled counts
+        window_lengths = np.minimum(end * coef, lengths) - start * coef
+        offsets = np.concatenate([[0], lengths[:-1].cumsum()])
+        bins = np.concatenate([
+            np.arange(offset + first, offset + first + length)
+            for offset, first, length in zip(offsets, start * coef,
+                                             window_lengths)])
+        counts, lengths = utils.downsample_resolution(
+            counts[np.ix_(bins, bins)], window_lengths, coefficient=coef)
+        begin = start * level
+        copy = False
+    counts = _working_buffer(counts, lengths, normalize=normalize, copy=copy)
 
+    offsets = np.concatenate([[0], lengths[:-1].cumsum()])
+    candidates = [[candidate] for candidate in
+                  (centromeres_calls - begin) / level + offsets]
+    centromeres_calls = prelocalization_.optimize_centromeres(
+        counts, lengths, candidates,
+        sigma=1, verbose=verbose, copy=False, cache=cache)
+    return (centromeres_calls - offsets) * level + begin
+
+
+def _working_buffer(counts, lengths, normalize=True, copy=True):
+    """
+    Returns the masked, and if normalize is True normalized, counts as a
+    float array
+
+    If copy is False, counts may be modified, and is returned itself when
+    normalize is False and counts is a float array.
+    """
     if normalize:
-        counts = iced.normalization.ICE_normalization(counts)
-
-    mask = iced.utils.get_intra_mask(lengths)
-    counts[mask] = 0
-    if coef != 1:
-        centromeres_calls = prelocalization_.optimize_centromeres(
-            counts, lengths, candidates,
-            sigma=1, verbose=verbose)
+        # ICE_normalization always returns a new float array, and only writes
+        # to its input to set the NaNs to 0: the copy is only needed then.
+        counts = iced.normalization.ICE_normalization(
+            counts, copy=copy and np.isnan(counts).any())
+    elif copy:
+        counts = np.array(counts, dtype=float)
     else:
-        centromeres_calls = centromeres_calls_40kb
-    centromeres_calls[1:] -= lengths[:-1].cumsum()
-    centromeres_calls *= resolution
-    return np.round(centromeres_calls).astype(int)
+        counts = np.asarray(counts, dtype=float)
+    return utils.mask_intra_counts(counts, lengths)
 
 
 def centromeres_calls_(counts, lengths, sigma=4, init=None,
                        n_candidate=2, verbose=2, copy=True,
-                       filter_candidates=False, max_trials=30, njobs=1):
+                       filter_candidates=False, max_trials=30, njobs=1,
+                       cache=None):
     """
     """
     if copy:
         counts = counts.copy()
-    mask = iced.utils.get_intra_mask(lengths)
-    counts[mask] = 0
+    utils.mask_intra_counts(counts, lengths)
 
     candidate_centromeres = prelocalization_.find_centromeres_candidates(
-        counts, lengths, n_candidate=n_candidate, verbose=verbose)
+        counts, lengths, n_candidate=n_candidate, verbose=verbose,
+        njobs=njobs)
     potential_candidates = np.prod([len(i) for i in candidate_centromeres])
     if filter_candidates and potential_candidates > max_trials:
         refined_candidates = prelocalization_.filter_centromeres_candidates(
-            counts, lengths, candidate_centromeres, sigma=sigma,
-            verbose=verbose)
+            counts, lengths, candidate_centromeres, copy=False, sigma=sigma,
+            verbose=verbose, njobs=njobs)
     else:
         refined_candidates = candidate_centromeres
     centromeres_calls = prelocalization_.optimize_centromeres(
         counts, lengths, refined_candidates, sigma=sigma, njobs=njobs,
-        verbose=verbose)
+        verbose=verbose, copy=False, cache=cache)
     return centromeres_calls
@@ -1,5 +1,40 @@
 import numpy as np
 from scipy import optimize
+from scipy.sparse import csr_matrix, coo_matrix
+
+
+def _chromosome_bounds(lengths):
+    """
+    Returns the first and last bin of each chromosome
+    """
+    begin = np.concatenate([[0], lengths.cumsum()])[:-1]
+    end = lengths.cumsum() - 1
+    return begin, end
+
+
+def _position_penalty(p, begin, end):
+    """
+    Penalty keeping the centromere positions inside their chromosome
+
+    Returns
+    -------
+    penalty : float
+        the penalty added to every residual
+
+    gradient : ndarray (L, )
+        derivative of the penalty with respect to the positions
+    """
+    penalty = 0
+    gradient = np.zeros(len(p))
+    # Only active with the unconstrained leastsq solver: the trf solver keeps
+    # the positions inside their bounds.
+    if np.any(p[p > end]) or np.any(p[p < begin]):
+        d = ((p[p > end] - end[p > end]) ** 2).sum()
+        d += ((p[p < begin] - begin[p < begin]) ** 2).sum()
+        penalty = 10e8 * d
+        gradient[p > end] = 2 * 10e8 * (p - end)[p > end]
+        gradient[p < begin] = 2 * 10e8 * (p - begin)[p < begin]
+    return penalty, gradient
 
 
 def objective_function(x, lengths=None, counts=None):
@@ -12,15 +47,8 @@ def objective_function(x, lengths=None, counts=None):
     b = x[len(lengths) + 1]
     sigma = x[len(lengths) + 2]
 
-    p1 = np.array([i for i, l in enumerate(lengths) for j in range(int(l))])
-    begin = np.concatenate([[0], lengths.cumsum()])[:-1]
-    end = lengths.cumsum() - 1
-    penalty = 0
-    # FIXME this is not useful. Should add proper constraints
-    if np.any(p[p > end]) or np.any(p[p < begin]):
-        d = ((p[p > end] - end[p > end]) ** 2).sum()
-        d += ((p[p < begin] - begin[p < begin]) ** 2).sum()
-        penalty = 10e8 * d
+    p1 = np.repeat(np.arange(len(lengths)), lengths.astype(int))
+    penalty, _ = _position_penalty(p, *_chromosome_bounds(lengths))
 
     if counts is None:
         counts = 1
@@ -31,17 +59,1077 @@ def objective_function(x, lengths=None, counts=None):
             - (p[p1[y]] - y) ** 2 / (2 * sigma ** 2)) + b) + penalty
 
 
+def _median_with_zeros(data, size):
+    """
+    Median of an array of size entries, whose non zero entries are data,
+    without building the array
+    """
+    if np.isnan(data).any():
+        return np.nan
+    data = np.sort(data)
+    n_negative = np.searchsorted(data, 0)
+    n_zeros = size - len(data)
+
+    def order_statistic(k):
+        if k < n_negative:
+            return data[k]
+        elif k < n_negative + n_zeros:
+            return 0.
+        return data[k - n_zeros]
+
+    return 0.5 * (order_statistic((size - 1) // 2) +
+                  order_statistic(size // 2))
+
+
+class FitProblem(object):
+    """
+    Precomputed data of the centromere model fit
+
+    Everything that only depends on the contact count matrix and on the
+    lengths (the bin to chromosome map, the chromosome boundaries, the
+    entries entering the residuals, the sufficient statistics of the scalar
+    objective and the jacobian buffer) is computed once, and shared by all
+    the fits on the same data. Only arrays of the size of the entries are
+    kept: counts isn't copied.
+
+    Parameters
+    ----------
+    counts : ndarray n x n
+        Contact count matrix.
+
+    lengths : ndarray (L, )
+        Length of each chromosome.
+
+    nonzero : boolean, optional, default: True
+        whether the model is only evaluated on the non zero entries of
+        counts, all other entries of the model being set to 0.
+
+    sparse : boolean, optional, default: True
+        whether to only build the residuals on the non zero entries of
+        counts, in the order of np.nonzero. When nonzero is True, all the
+        others are only the penalty keeping the positions inside their
+        chromosome: they are gathered in one last residual, so that the sum
+        of squares is the one of the n x n residuals. If False, the residuals
+        are built on the n x n entries, in the order of np.ravel.
+
+    symmetric : boolean, optional, default: False
+        whether counts is symmetric. If True, only the upper triangle of
+        counts is used: there are half as many residuals, the diagonal ones
+        being scaled by 1 / sqrt(2), so that their sum of squares is exactly
+        half of the one on the full matrix. objective still returns the value
+        on the full matrix.
+
+    Attributes
+    ----------
+    chromosomes : ndarray (n, )
+        the chromosome of each bin
+
+    begin, end : ndarray (L, )
+        the first and last bin of each chromosome, ie the bounds of the
+        centromere positions.
+
+    rows, cols, values : ndarray (m, )
+        the entries of counts on which the residuals are computed.
+
+    n_residuals : integer
+        the number of residuals: m, plus one in sparse mode.
+    """
+
+    def __init__(self, counts, lengths, nonzero=True, sparse=True,
+                 symmetric=False):
+        if sparse and not nonzero:
+            raise ValueError("The sparse residuals can only be used when "
+                             "fitting the non zero entries of counts.")
+        self.lengths = lengths.astype(int)
+        self.n_chromosomes = len(lengths)
+        self.n = self.lengths.sum()
+        self.nonzero = nonzero
+        self.symmetric = symmetric
+        self.chromosomes = np.repeat(np.arange(self.n_chromosomes),
+                                     self.lengths)
+        self.positions = np.arange(self.n)
+        self.begin, self.end = _chromosome_bounds(self.lengths)
+
+        if sparse:
+            self.rows, self.cols = np.nonzero(counts)
+            if symmetric:
+                upper = self.rows <= self.cols
+                self.rows, self.cols = self.rows[upper], self.cols[upper]
+        elif symmetric:
+            self.rows, self.cols = np.triu_indices(self.n)
+        else:
+            self.rows, self.cols = [i.ravel() for i in np.indices(
+                counts.shape)]
+        self.values = counts[self.rows, self.cols]
+        if nonzero and not sparse:
+            self.weights = (self.values != 0).astype(float)
+        else:
+            self.weights = None
+        # In the upper triangle, each off diagonal entry stands for two
+        # entries of counts, and each diagonal entry for one.
+        if symmetric and np.any(self.rows == self.cols):
+            self.scale = np.where(self.rows == self.cols, np.sqrt(0.5), 1.)
+            self._n_residuals = (self.scale ** 2).sum()
+        else:
+            self.scale = None
+            self._n_residuals = len(self.rows)
+        self._multiplicity = 2 if symmetric else 1
+        if sparse:
+            # Number of entries left out, weighted like the squared residuals
+            self._n_missing = max(
+                self.n ** 2 / float(self._multiplicity) - self._n_residuals,
+                0)
+            self.n_residuals = len(self.rows) + 1
+        else:
+            self._n_missing = None
+            self.n_residuals = len(self.rows)
+
+        # Flat indices, in the jacobian, of the derivative of each entry with
+        # respect to the position of its row and column chromosomes
+        entries = np.arange(len(self.rows))
+        self._row_index = self.chromosomes[self.rows] * self.n_residuals + \
+            entries
+        self._col_index = self.chromosomes[self.cols] * self.n_residuals + \
+            entries
+        self._jacobian_buffer = None
+
+        # Sufficient statistics of the scalar objective, weighted like the
+        # squared residuals
+        contacts = csr_matrix(counts)
+        contacts.eliminate_zeros()
+        contacts = coo_matrix(contacts)
+        row, col, data = contacts.row, contacts.col, contacts.data
+        self._median = _median_with_zeros(data, counts.size)
+        if symmetric:
+            upper = row <= col
+            row, col, data = row[upper], col[upper], data[upper]
+            weights = np.where(row == col, 0.5, 1.)
+        else:
+            weights = np.ones(len(data))
+        self._counts = csr_matrix((weights * data, (row, col)),
+                                  shape=counts.shape)
+        if nonzero:
+            self._mask = csr_matrix((weights, (row, col)),
+                                    shape=counts.shape)
+            self._n_entries = weights.sum()
+        else:
+            self._mask = None
+            self._n_entries = self.n ** 2 / self._multiplicity
+        self._sum_counts = (weights * data).sum()
+        self._sum_squares = (weights * data ** 2).sum()
+
+        self._max = counts.max()
+        self._structure = None
+
+    @property
+    def jacobian_buffer(self):
+        """
+        (L + 3, n_residuals) buffer of the jacobian, allocated on first use
+        """
+        if self._jacobian_buffer is None:
+            self._jacobian_buffer = np.empty((self.n_chromosomes + 3,
+                                              self.n_residuals))
+        return self._jacobian_buffer
+
+    def initial_parameters(self, positions, sigma):
+        """
+        Returns the initial parameters of a fit starting at positions
+        """
+        return np.concatenate([positions,
+                               [self._max - self._median,
+                                self._median,
+                                sigma]])
+
+    def bounds(self):
+        """
+        Returns the lower and upper bounds of the parameters
+
+        The positions are bounded by their chromosome, the amplitude is
+        positive and sigma is at least half a bin: narrower gaussians only
+        fit isolated entries.
+        """
+        lower = np.concatenate([self.begin, [0, -np.inf, 0.5]])
+        upper = np.concatenate([self.end, [np.inf, np.inf, np.inf]])
+        return lower, upper
+
+    def sum_of_squares(self, residuals):
+        """
+        Returns the objective value of residuals, along the last axis
+        """
+        return self._multiplicity * (residuals ** 2).sum(axis=-1)
+
+    def _unpack(self, x):
+        p = x[:self.n_chromosomes]
+        a = x[self.n_chromosomes]
+        b = x[self.n_chromosomes + 1]
+        sigma = x[self.n_chromosomes + 2]
+        return p, a, b, sigma
+
+    def _profile(self, p, sigma):
+        u = p[self.chromosomes] - self.positions
+        g = np.exp(- u ** 2 / (2 * sigma ** 2))
+        return u, g
+
+    def residuals(self, x, out=None):
+        """
+        Model minus data on the (rows, cols) entries, followed in sparse mode
+        by the penalty of the entries left out
+        """
+        p, a, b, sigma = self._unpack(x)
+        _, g = self._profile(p, sigma)
+        penalty, _ = _position_penalty(p, self.begin, self.end)
+        if out is None:
+            out = np.empty(self.n_residuals)
+        entries = out[:len(self.rows)]
+        np.multiply(g[self.rows], g[self.cols], out=entries)
+        entries *= a
+        entries += b
+        if self.weights is not None:
+            entries *= self.weights
+        entries += penalty
+        entries -= self.values
+        if self.scale is not None:
+            entries *= self.scale
+        if self._n_missing is not None:
+            out[-1] = np.sqrt(self._n_missing) * penalty
+        return out
+
+    def jacobian(self, x, out=None):
+        """
+        Jacobian of the residuals, of shape (L + 3, n_residuals)
+
+        The position of chromosome k only affects the entries whose row or
+        column belongs to chromosome k.
+        """
+        p, a, b, sigma = self._unpack(x)
+        u, g = self._profile(p, sigma)
+        _, penalty_gradient = _position_penalty(p, self.begin, self.end)
+        if out is None:
+            out = np.empty((self.n_chromosomes + 3, self.n_residuals))
+        m = len(self.rows)
+
+        gaussian = out[self.n_chromosomes, :m]
+        np.multiply(g[self.rows], g[self.cols], out=gaussian)
+        if self.weights is not None:
+            gaussian *= self.weights
+
+        out[:self.n_chromosomes] = penalty_gradient[:, np.newaxis]
+        flat = out.reshape(-1)
+        flat[self._row_index] -= a / sigma ** 2 * gaussian * u[self.rows]
+        flat[self._col_index] -= a / sigma ** 2 * gaussian * u[self.cols]
+        if self.weights is not None:
+            out[self.n_chromosomes + 1, :m] = self.weights
+        else:
+            out[self.n_chromosomes + 1, :m] = 1
+        out[self.n_chromosomes + 2, :m] = \
+            a / sigma ** 3 * gaussian * (u[self.rows] ** 2 + u[self.cols] ** 2)
+        if self.scale is not None:
+            out[:, :m] *= self.scale
+        if self._n_missing is not None:
+            out[:self.n_chromosomes, -1] = \
+                np.sqrt(self._n_missing) * penalty_gradient
+            out[self.n_chromosomes:, -1] = 0
+        return out
+
+    def residuals_batch(self, X):
+        """
+        Residuals of K parameter vectors at once, of shape (K, m)
+
+        The positions are assumed to be inside their bounds: no penalty is
+        added, and the last residual of sparse mode, which is only the
+        penalty, is left out.
+        """
+        p = X[:, :self.n_chromosomes]
+        a = X[:, self.n_chromosomes, np.newaxis]
+        b = X[:, self.n_chromosomes + 1, np.newaxis]
+        sigma = X[:, self.n_chromosomes + 2, np.newaxis]
+        g = np.exp(- (p[:, self.chromosomes] - self.positions) ** 2 /
+                   (2 * sigma ** 2))
+        residuals = a * np.take(g, self.rows, axis=1) * \
+            np.take(g, self.cols, axis=1) + b
+        if self.weights is not None:
+            residuals *= self.weights
+        residuals -= self.values
+        if self.scale is not None:
+            residuals *= self.scale
+        return residuals
+
+    def jacobian_batch(self, X):
+        """
+        Jacobian of the residuals of K parameter vectors at once, of shape
+        (K, L + 3, m)
+
+        The positions are assumed to be inside their bounds: no penalty is
+        added.
+        """
+        n_batch = len(X)
+        p = X[:, :self.n_chromosomes]
+        a = X[:, self.n_chromosomes, np.newaxis]
+        sigma = X[:, self.n_chromosomes + 2, np.newaxis]
+        u = p[:, self.chromosomes] - self.positions
+        g = np.exp(- u ** 2 / (2 * sigma ** 2))
+
+        # Allocated with the width of the jacobian, whose flat indices it
+        # shares, and returned without the last residual of sparse mode
+        out = np.zeros((n_batch, self.n_chromosomes + 3, self.n_residuals))
+        flat = out.reshape(n_batch, -1)
+        out = out[..., :len(self.rows)]
+        gaussian = out[:, self.n_chromosomes]
+        np.multiply(np.take(g, self.rows, axis=1),
+                    np.take(g, self.cols, axis=1), out=gaussian)
+        if self.weights is not None:
+            gaussian *= self.weights
+
+        u_rows = np.take(u, self.rows, axis=1)
+        u_cols = np.take(u, self.cols, axis=1)
+        flat[:, self._row_index] -= a / sigma ** 2 * gaussian * u_rows
+        flat[:, self._col_index] -= a / sigma ** 2 * gaussian * u_cols
+        if self.weights is not None:
+            out[:, self.n_chromosomes + 1] = self.weights
+        else:
+            out[:, self.n_chromosomes + 1] = 1
+        out[:, self.n_chromosomes + 2] = (
+            a / sigma ** 3 * gaussian * (u_rows ** 2 + u_cols ** 2))
+        if self.scale is not None:
+            out *= self.scale
+        return out
+
+    def _gaussian_sums(self, p, sigma):
+        """
+        Sums of g(x) g(y), of g(x)^2 g(y)^2 and of g(x) g(y) * counts over the
+        modelled entries, in three sparse matrix-vector products.
+        """
+        _, g = self._profile(p, sigma)
+        if self._mask is None:
+            sum_gaussian = g.sum() ** 2 / self._multiplicity
+            sum_gaussian_squares = (g ** 2).sum() ** 2 / self._multiplicity
+        else:
+            sum_gaussian = g.dot(self._mask.dot(g))
+            sum_gaussian_squares = (g ** 2).dot(self._mask.dot(g ** 2))
+        sum_gaussian_counts = g.dot(self._counts.dot(g))
+        return sum_gaussian, sum_gaussian_squares, sum_gaussian_counts
+
+    def linear_parameters(self, p, sigma):
+        """
+        Amplitude and baseline minimizing the objective for fixed centromere
+        positions p and sigma.
+
+        The model is linear in a and b: they solve the 2 x 2 normal equations
+        built from the sums of objective.
+        """
+        sum_gaussian, sum_gaussian_squares, sum_gaussian_counts = \
+            self._gaussian_sums(p, sigma)
+        normal = np.array([[sum_gaussian_squares, sum_gaussian],
+                           [sum_gaussian, self._n_entries]])
+        a, offset = np.dot(np.linalg.pinv(normal),
+                           [sum_gaussian_counts, self._sum_counts])
+        # The optimal offset of the modelled entries includes the penalty
+        penalty, _ = _position_penalty(p, self.begin, self.end)
+        return a, offset - penalty
+
+    def _symmetrized(self):
+        """
+        Weights and weighted counts on the full matrix, symmetrized
+
+        The model is symmetric, so replacing the weights and the counts by
+        their symmetric part leaves the objective unchanged, and the products
+        of the columns of the jacobian only need one matrix-vector product
+        each. Computed on the first call.
+        """
+        if self._structure is None:
+            half = self._multiplicity / 2.
+            counts = half * (self._counts + self._counts.T)
+            if self._mask is None:
+                mask, rows, cols = None, None, None
+            else:
+                mask = (half * (self._mask + self._mask.T)).tocsr()
+                entries = mask.tocoo()
+                rows, cols = entries.row, entries.col
+            self._structure = (mask, rows, cols, counts.tocsr())
+        return self._structure
+
+    def normal_equations(self, x):
+        """
+        Gauss-Newton normal equations at x, without building the jacobian
+
+        The position of chromosome k only affects the entries in the rows and
+        columns of chromosome k: every product of two columns of the
+        jacobian reduces to sums over the bins, a few sparse matrix-vector
+        products and one sum of the weighted contacts per pair of
+        chromosomes. The cost is linear in the number of contacts, whatever
+        the number of chromosomes. The positions are assumed to be inside
+        their bounds: the penalty is ignored.
+
+        Returns
+        -------
+        hessian : ndarray (L + 3, L + 3)
+            J^T J, the Gauss-Newton approximation of half the hessian of
+            objective.
+
+        gradient : ndarray (L + 3, )
+            J^T r, half the gradient of objective.
+        """
+        p, a, b, sigma = self._unpack(x)
+        u, g = self._profile(p, sigma)
+        mask, rows, cols, counts = self._symmetrized()
+        L = self.n_chromosomes
+        if mask is None:
+            dot = lambda v: np.full(self.n, v.sum())
+            n_entries = float(self.n ** 2)
+        else:
+            dot = mask.dot
+            n_entries = self._multiplicity * self._n_entries
+
+        # Derivatives of the profile with respect to the position of its
+        # chromosome and to sigma
+        dg_position = - g * u / sigma ** 2
+        dg_sigma = g * u ** 2 / sigma ** 3
+        mask_g = dot(g)
+        mask_g2 = dot(g ** 2)
+        weighted = dg_position * g
+        mask_sigma = dot(dg_sigma * g)
+        # Weighted residuals, summed along each row against the profile
+        z = a * g * mask_g2 + b * mask_g - counts.dot(g)
+
+        chromosome_sum = lambda v: np.bincount(self.chromosomes, v,
+                                               minlength=L)
+        if mask is None:
+            cross = np.outer(chromosome_sum(weighted),
+                             chromosome_sum(weighted))
+        else:
+            pairs = self.chromosomes[rows] * L + self.chromosomes[cols]
+            cross = np.bincount(
+                pairs, weighted[rows] * mask.data * weighted[cols],
+                minlength=L * L).reshape(L, L)
+
+        hessian = np.empty((L + 3, L + 3))
+        gradient = np.empty(L + 3)
+        hessian[:L, :L] = 2 * a ** 2 * (
+            np.diag(chromosome_sum(dg_position ** 2 * mask_g2)) + cross)
+        hessian[:L, L] = 2 * a * chromosome_sum(weighted * mask_g2)
+        hessian[:L, L + 1] = 2 * a * chromosome_sum(dg_position * mask_g)
+        hessian[:L, L + 2] = 2 * a ** 2 * chromosome_sum(
+            dg_position * dg_sigma * mask_g2 + weighted * mask_sigma)
+        hessian[L, L] = (g ** 2).dot(mask_g2)
+        hessian[L, L + 1] = g.dot(mask_g)
+        hessian[L, L + 2] = 2 * a * (dg_sigma * g).dot(mask_g2)
+        hessian[L + 1, L + 1] = n_entries
+        hessian[L + 1, L + 2] = 2 * a * dg_sigma.dot(mask_g)
+        hessian[L + 2, L + 2] = 2 * a ** 2 * (
+            (dg_sigma ** 2).dot(mask_g2) + (dg_sigma * g).dot(mask_sigma))
+        lower = np.tril_indices(L + 3, -1)
+        hessian[lower] = hessian.T[lower]
+
+        gradient[:L] = 2 * a * chromosome_sum(dg_position * z)
+        gradient[L] = g.dot(z)
+        gradient[L + 1] = (a * hessian[L, L + 1] + b * n_entries -
+                           self._multiplicity * self._sum_counts)
+        gradient[L + 2] = 2 * a * dg_sigma.dot(z)
+        return hessian, gradient
+
+    def objective(self, x):
+        """
+        Sum of the squared residuals, without building the residuals
+
+        The model a * g(x) g(y) + b is separable, so the sum of squared
+        residuals only involves the sums of the counts and of their squares,
+        computed once, and three sparse matrix-vector products.
+        """
+        p, a, b, sigma = self._unpack(x)
+        sum_gaussian, sum_gaussian_squares, sum_gaussian_counts = \
+            self._gaussian_sums(p, sigma)
+        # The penalty is added to every residual. On the modelled entries, it
+        # acts as an offset of the baseline, and b can compensate it: adding
+        # them first avoids cancellations between b and the penalty.
+        penalty, _ = _position_penalty(p, self.begin, self.end)
+        offset = b + penalty
+        # sum of model * counts, and of model ** 2 over the modelled entries
+        cross = a * sum_gaussian_counts + offset * self._sum_counts
+        squares = (a ** 2 * sum_gaussian_squares +
+                   2 * a * offset * sum_gaussian +
+                   offset ** 2 * self._n_entries)
+        value = squares - 2 * cross + self._sum_squares
+        # The other entries of the n x n residuals are only the penalty
+        value += (self.n ** 2 / float(self._multiplicity) -
+                  self._n_entries) * penalty ** 2
+        return self._multiplicity * value
+
+
 def fit_gaussian(data, init, lengths, counts=False, factor=1, ftol=1e-10,
-                 gtol=1e-10, xtol=1e-10):
-    if counts:
-        counts = data
+                 gtol=1e-10, xtol=1e-10, jacobian=True, sparse=False,
+                 problem=None, solver="leastsq", maxfev=100000,
+                 symmetric=False, variable_projection=False,
+                 abandon_above=None, abandon_after=10):
+    """
+    Fit the gaussian centromere model to the contact counts
+
+    Parameters
+    ----------
+    data : ndarray n x n
+        Contact count matrix.
+
+    init : ndarray (L + 3, )
+        initial centromere positions, amplitude, baseline and sigma.
+
+    lengths : ndarray (L, )
+        Length of each chromosome.
+
+    counts : boolean, optional, default: False
+        whether to only fit the non zero entries of data.
+
+    factor : float, optional, default: 1
+        initial step bound of leastsq. Ignored by the trf solver.
+
+    jacobian : boolean, optional, default: True
+        whether to provide the analytic jacobian to the solver. If False, the
+        jacobian is estimated by forward differences.
+
+    sparse : boolean, optional, default: False
+        whether to only build the residuals on the non zero entries of data,
+        in the order of np.nonzero. The residual vector then has one entry
+        per contact instead of n x n, and a last one gathering the penalty
+        of all the others, which keeps the same sum of squares. Requires
+        counts to be True.
+
+    problem : FitProblem, optional, default: None
+        precomputed fit problem on data. If provided, counts, sparse and
+        symmetric are ignored.
+
+    solver : {"leastsq", "trf", "structured"}, optional, default: "leastsq"
+        "leastsq" is MINPACK's Levenberg-Marquardt, where the positions are
+        kept inside their chromosome by a penalty. "trf" is the bounded
+        trust region reflective solver of scipy.optimize.least_squares: each
+        position is bounded by its chromosome, the amplitude and sigma are
+        positive, and the parameters are scaled by the norms of the columns
+        of the jacobian. "structured" is a Levenberg-Marquardt on the normal
+        equations of FitProblem.normal_equations, which never builds the
+        residuals nor the jacobian, with the same bounds as "trf" and the
+        steps of fit_gaussian_batch. It ignores factor, jacobian and
+        variable_projection.
+
+    maxfev : integer, optional, default: 100000
+        maximum number of evaluations of the residuals.
+
+    symmetric : boolean, optional, default: False
+        whether data is symmetric. If True, the residuals are only built on
+        the upper triangle, which gives the same optimum at half the cost.
+
+    variable_projection : boolean, optional, default: False
+        whether to solve for the amplitude and the baseline in closed form at
+        each evaluation of the residuals. The solver then only searches over
+        the L positions and sigma, and the values of init for a and b are
+        ignored.
+
+    abandon_above : float, optional, default: None
+        If provided, the fit is abandoned as soon as the lowest objective
+        value evaluated is still above abandon_above after abandon_after
+        evaluations. It then returns the best parameters evaluated, with
+        cov_x set to None and ier to -1.
+
+    abandon_after : integer, optional, default: 10
+        number of evaluations before a fit can be abandoned.
+
+    Returns
+    -------
+    The output of scipy.optimize.leastsq with full_output=True. With the trf
+    and structured solvers, infodict only contains "fvec", "nfev" and
+    "njev". The structured solver sets ier to 6 when no step reduces the
+    objective, and to -2 when the fit ends with no gaussian (a = 0) or
+    with every position on a chromosome end. With variable_projection, the
+    parameters are the full L + 3 vector, and cov_x is the covariance of
+    the positions and sigma.
+    """
+    if problem is None:
+        problem = FitProblem(data, lengths, nonzero=bool(counts),
+                             sparse=sparse, symmetric=symmetric)
+    if solver not in ("leastsq", "trf", "structured"):
+        raise ValueError("Unknown solver %s" % solver)
+    if abandon_above is None:
+        residuals, objective = problem.residuals, problem.objective
+    else:
+        monitor = _EarlyAbandon(problem, abandon_above, abandon_after)
+        residuals, objective = monitor.residuals, monitor.objective
+
+    try:
+        if solver == "structured":
+            return _fit_gaussian_structured(problem, init, ftol=ftol,
+                                            xtol=xtol, gtol=gtol,
+                                            maxfev=maxfev,
+                                            objective=objective)
+        elif variable_projection:
+            return _fit_gaussian_varpro(problem, init, factor=factor,
+                                        ftol=ftol, gtol=gtol, xtol=xtol,
+                                        jacobian=jacobian, solver=solver,
+                                        maxfev=maxfev, residuals=residuals)
+        elif solver == "trf":
+            return _fit_gaussian_trf(problem, init, ftol=ftol, gtol=gtol,
+                                     xtol=xtol, jacobian=jacobian,
+                                     maxfev=maxfev, residuals=residuals)
+        return _fit_gaussian_leastsq(problem, init, factor=factor, ftol=ftol,
+                                     gtol=gtol, xtol=xtol, jacobian=jacobian,
+                                     maxfev=maxfev, residuals=residuals)
+    except _FitAbandoned:
+        infodict = {"fvec": problem.residuals(monitor.x),
+                    "nfev": monitor.nfev}
+        mesg = ("The objective is above abandon_above after %d evaluations"
+                % monitor.nfev)
+        return monitor.x, None, infodict, mesg, -1
+
+
+class _FitAbandoned(Exception):
+    pass
+
+
+class _EarlyAbandon(object):
+    """
+    Evaluates the residuals or the objective of problem, and abandons the fit
+    once the lowest objective value evaluated is still above threshold after
+    n_evaluations evaluations
+
+    The lowest objective value evaluated is an upper bound of the objective
+    of the current iterate: the solvers only accept steps decreasing it.
+    """
+
+    def __init__(self, problem, threshold, n_evaluations):
+        self.problem = problem
+        self.threshold = threshold
+        self.n_evaluations = n_evaluations
+        self.nfev = 0
+        self.fval = np.inf
+        self.x = None
+
+    def _record(self, x, fval):
+        self.nfev += 1
+        if fval < self.fval:
+            self.fval, self.x = fval, np.array(x, dtype=float)
+        if self.nfev >= self.n_evaluations and self.fval > self.threshold:
+            raise _FitAbandoned()
+
+    def residuals(self, x):
+        residuals = self.problem.residuals(x)
+        self._record(x, self.problem.sum_of_squares(residuals))
+        return residuals
+
+    def objective(self, x):
+        fval = self.problem.objective(x)
+        self._record(x, fval)
+        return fval
+
+
+def _fit_gaussian_leastsq(problem, init, factor=1, ftol=1e-10, gtol=1e-10,
+                          xtol=1e-10, jacobian=True, maxfev=100000,
+                          residuals=None):
+    """
+    Fit the gaussian centromere model with MINPACK's Levenberg-Marquardt
+
+    If provided, residuals replaces problem.residuals.
+    """
+    # MINPACK factorizes the jacobian in place, so leastsq always copies it
+    # and the buffer can be reused. The residuals can't: the forward
+    # difference driver keeps references to them.
+    errorfunction = problem.residuals if residuals is None else residuals
+    if jacobian:
+        dfun = lambda p: problem.jacobian(p, out=problem.jacobian_buffer)
     else:
-        counts = None
-    errorfunction = lambda p: np.ravel(
-        objective_function(p, lengths=lengths, counts=counts)(
-            *np.indices(data.shape)) - data)
-    res = optimize.leastsq(errorfunction, init, factor=factor,
-                           full_output=True, maxfev=100000,
+        dfun = None
+    res = optimize.leastsq(errorfunction, init, Dfun=dfun, col_deriv=True,
+                           factor=factor,
+                           full_output=True, maxfev=maxfev,
                            ftol=ftol, gtol=gtol, xtol=xtol)
 
     return res
+
+
+# Convergence code of scipy.optimize.leastsq for each status of
+# scipy.optimize.least_squares: maxfev, gtol, ftol, xtol, and both ftol and
+# xtol
+_LEASTSQ_IER = {0: 5, 1: 4, 2: 1, 3: 2, 4: 3}
+
+
+def _fit_gaussian_trf(problem, init, ftol=1e-10, gtol=1e-10, xtol=1e-10,
+                      jacobian=True, maxfev=100000, residuals=None):
+    """
+    Fit the gaussian centromere model with a bounded trust region solver
+
+    If provided, residuals replaces problem.residuals. Returns the same
+    output as scipy.optimize.leastsq with full_output=True
+    """
+    if residuals is None:
+        residuals = problem.residuals
+    lower, upper = problem.bounds()
+    init = np.clip(init, lower, upper)
+    if jacobian:
+        # least_squares keeps the jacobian of the last accepted step: it
+        # can't share the buffer.
+        jac = lambda p: problem.jacobian(p).T
+    else:
+        jac = "2-point"
+    res = optimize.least_squares(residuals, init, jac=jac,
+                                 bounds=(lower, upper), method="trf",
+                                 x_scale="jac", max_nfev=maxfev,
+                                 ftol=ftol, gtol=gtol, xtol=xtol)
+    try:
+        cov_x = np.linalg.inv(np.dot(res.jac.T, res.jac))
+    except np.linalg.LinAlgError:
+        cov_x = None
+    infodict = {"fvec": res.fun, "nfev": res.nfev, "njev": res.njev}
+    return res.x, cov_x, infodict, res.message, _LEASTSQ_IER[res.status]
+
+
+def _fit_gaussian_structured(problem, init, ftol=1e-10, xtol=1e-10,
+                             gtol=1e-10, maxfev=100000, objective=None):
+    """
+    Fit the gaussian centromere model by Levenberg-Marquardt on the
+    structured normal equations
+
+    Each iteration costs one FitProblem.normal_equations and one
+    FitProblem.objective, both linear in the number of contacts. The
+    parameters are kept inside the bounds of FitProblem, with the steps and
+    convergence tests of fit_gaussian_batch.
+
+    If provided, objective replaces problem.objective. Returns the same
+    output as scipy.optimize.leastsq with full_output=True
+    """
+    if objective is None:
+        objective = problem.objective
+    lower, upper = problem.bounds()
+    x = np.clip(np.array(init, dtype=float), lower, upper)
+    fval = objective(x)
+    nfev, njev = 1, 0
+    damping = 1e-3
+    outdated = True
+    while True:
+        if outdated:
+            hessian, gradient = problem.normal_equations(x)
+            njev += 1
+            outdated = False
+        if _small_gradient(hessian[np.newaxis], gradient[np.newaxis],
+                           x[np.newaxis], lower, upper, np.array([fval]),
+                           gtol)[0]:
+            ier, mesg = 4, "The cosine of the angle between the residuals " \
+                "and any free column of the jacobian is at most gtol"
+            break
+        trial, predicted = _bounded_steps(
+            hessian[np.newaxis], gradient[np.newaxis], x[np.newaxis], lower,
+            upper, np.array([damping]))
+        trial, predicted = trial[0], predicted[0]
+        step = trial - x
+        trial_fval = objective(trial)
+        nfev += 1
+
+        accepted = trial_fval < fval
+        scale = max(fval, 1e-300)
+        small_reduction = (accepted and (fval - trial_fval) / scale <= ftol
+                           and predicted / scale <= ftol)
+        small_step = accepted and np.sqrt((step ** 2).sum()) <= xtol * (
+            xtol + np.sqrt((x ** 2).sum()))
+        if accepted:
+            x, fval = trial, trial_fval
+            outdated = True
+            damping = max(damping / 10, 1e-12)
+        else:
+            damping *= 10
+
+        if small_reduction and small_step:
+            ier, mesg = 3, "Both the relative reduction of the objective " \
+                "and the relative step are at most ftol and xtol"
+        elif small_reduction:
+            ier, mesg = 1, "The relative reduction of the objective is at " \
+                "most ftol"
+        elif small_step:
+            ier, mesg = 2, "The relative step is at most xtol"
+        elif damping > 1e12:
+            ier, mesg = 6, "No step reduces the objective"
+        elif nfev >= maxfev:
+            ier, mesg = 5, "The number of evaluations has reached maxfev"
+        else:
+            continue
+        break
+
+    if ier <= 4 and _degenerate(x[np.newaxis], lower, upper,
+                                problem.n_chromosomes)[0]:
+        ier, mesg = -2, "The fit has no gaussian, or every position on a " \
+            "chromosome end"
+    if outdated:
+        hessian, _ = problem.normal_equations(x)
+    try:
+        cov_x = np.linalg.inv(hessian)
+    except np.linalg.LinAlgError:
+        cov_x = None
+    infodict = {"fvec": problem.residuals(x), "nfev": nfev, "njev": njev}
+    return x, cov_x, infodict, mesg, ier
+
+
+def _fit_gaussian_varpro(problem, init, factor=1, ftol=1e-10, gtol=1e-10,
+                         xtol=1e-10, jacobian=True, solver="leastsq",
+                         maxfev=100000, residuals=None):
+    """
+    Fit the gaussian centromere model by variable projection
+
+    The amplitude and the baseline are eliminated by
+    FitProblem.linear_parameters, and the solver only sees the positions and
+    sigma. The jacobian is Kaufman's approximation: the columns of the
+    positions and sigma, projected on the orthogonal of the columns of a and
+    b.
+
+    If provided, residuals replaces problem.residuals. Returns the same
+    output as scipy.optimize.leastsq with full_output=True
+    """
+    if residuals is None:
+        residuals = problem.residuals
+    full_residuals = residuals
+    L = problem.n_chromosomes
+    nonlinear = np.append(np.arange(L), L + 2)
+
+    def full_parameters(theta):
+        x = np.empty(L + 3)
+        x[nonlinear] = theta
+        x[L], x[L + 1] = problem.linear_parameters(theta[:L], theta[L])
+        return x
+
+    def residuals(theta):
+        return full_residuals(full_parameters(theta))
+
+    def projected_jacobian(theta):
+        jac = problem.jacobian(full_parameters(theta),
+                               out=problem.jacobian_buffer)
+        linear = jac[L:L + 2]
+        projected = jac[nonlinear]
+        coef = np.dot(np.linalg.pinv(np.dot(linear, linear.T)),
+                      np.dot(linear, projected.T))
+        projected -= np.dot(coef.T, linear)
+        return projected
+
+    init = np.asarray(init, dtype=float)[nonlinear]
+    if solver == "trf":
+        lower, upper = [bound[nonlinear] for bound in problem.bounds()]
+        init = np.clip(init, lower, upper)
+        jac = ((lambda theta: projected_jacobian(theta).T) if jacobian
+               else "2-point")
+        res = optimize.least_squares(residuals, init, jac=jac,
+                                     bounds=(lower, upper), method="trf",
+                                     x_scale="jac", max_nfev=maxfev,
+                                     ftol=ftol, gtol=gtol, xtol=xtol)
+        try:
+            cov_x = np.linalg.inv(np.dot(res.jac.T, res.jac))
+        except np.linalg.LinAlgError:
+            cov_x = None
+        infodict = {"fvec": res.fun, "nfev": res.nfev, "njev": res.njev}
+        return (full_parameters(res.x), cov_x, infodict, res.message,
+                _LEASTSQ_IER[res.status])
+    elif solver != "leastsq":
+        raise ValueError("Unknown solver %s" % solver)
+
+    theta, cov_x, infodict, mesg, ier = optimize.leastsq(
+        residuals, init, Dfun=projected_jacobian if jacobian else None,
+        col_deriv=True, factor=factor, full_output=True, maxfev=maxfev,
+        ftol=ftol, gtol=gtol, xtol=xtol)
+    return full_parameters(theta), cov_x, infodict, mesg, ier
+
+
+def _free_parameters(X, gradient, lower, upper):
+    """
+    Whether each parameter of X can move: a parameter on one of its bounds,
+    whose gradient pushes it outside, is held fixed
+    """
+    return ~(((X <= lower) & (gradient > 0)) | ((X >= upper) & (gradient < 0)))
+
+
+def _bounded_steps(hessian, gradient, X, lower, upper, damping):
+    """
+    Levenberg-Marquardt steps of K fits on their normal equations, inside
+    the bounds
+
+    Only the free parameters move, and their step is projected on the
+    bounds. As the damping grows, the step tends to a projected scaled
+    gradient step, which decreases the objective unless X is a stationary
+    point on the bounds. Clipping the step of all the parameters instead
+    can stall on a bound far from any such point.
+
+    Returns
+    -------
+    trial : ndarray (K, P)
+        the parameters after the steps
+
+    predicted : ndarray (K, )
+        the reduction of the sum of squares predicted by the normal
+        equations, in the units of hessian and gradient
+    """
+    free = _free_parameters(X, gradient, lower, upper)
+    diagonal = np.arange(X.shape[1])
+    system = hessian * (free[:, :, np.newaxis] & free[:, np.newaxis])
+    scale = np.maximum(hessian[:, diagonal, diagonal], 1e-12)
+    system[:, diagonal, diagonal] = np.where(
+        free, system[:, diagonal, diagonal] + damping[:, np.newaxis] * scale,
+        1)
+    step = - np.linalg.solve(system, (free * gradient)[..., np.newaxis])[
+        ..., 0]
+    trial = np.clip(X + step, lower, upper)
+    step = trial - X
+    predicted = - (2 * (gradient * step).sum(axis=1) + np.matmul(
+        np.matmul(step[:, np.newaxis], hessian),
+        step[..., np.newaxis])[:, 0, 0])
+    return trial, predicted
+
+
+def _small_gradient(hessian, gradient, X, lower, upper, sum_squares, gtol):
+    """
+    Whether the cosine of the angle between the residuals and the column of
+    the jacobian of every free parameter is at most gtol, as in the gtol
+    test of leastsq
+    """
+    free = _free_parameters(X, gradient, lower, upper)
+    diagonal = np.arange(X.shape[1])
+    norms = np.sqrt(np.maximum(hessian[:, diagonal, diagonal], 0) *
+                    sum_squares[:, np.newaxis])
+    cosine = np.abs(gradient) / np.where(norms > 0, norms, 1)
+    return np.where(free & (norms > 0), cosine, 0).max(axis=1) <= gtol
+
+
+def _degenerate(X, lower, upper, n_chromosomes):
+    """
+    Whether the fits of X have no gaussian, or every position on a
+    chromosome end: their positions don't fit the contacts
+    """
+    positions = X[:, :n_chromosomes]
+    pinned = ((positions <= lower[:n_chromosomes]) |
+              (positions >= upper[:n_chromosomes])).all(axis=1)
+    return pinned | (X[:, n_chromosomes] <= lower[n_chromosomes])
+
+
+def fit_gaussian_batch(data, inits, lengths, problem=None, ftol=1e-8,
+                       xtol=1e-8, gtol=1e-8, max_iter=200):
+    """
+    Fit the gaussian centromere model from several initializations at once
+
+    All the fits are advanced together by a Levenberg-Marquardt algorithm:
+    at each iteration, the residuals and jacobians of all the unconverged
+    fits are evaluated in one vectorized call. A fit leaves the batch as
+    soon as it has converged. The parameters are kept inside the bounds of
+    FitProblem: the ones on a bound, whose gradient pushes them outside, are
+    held fixed, and the step of the others is projected on the bounds.
+
+    Parameters
+    ----------
+    data : ndarray n x n
+        Contact count matrix.
+
+    inits : ndarray (K, L + 3)
+        initial centromere positions, amplitude, baseline and sigma of each
+        fit.
+
+    lengths : ndarray (L, )
+        Length of each chromosome.
+
+    problem : FitProblem, optional, default: None
+        precomputed fit problem on data. If None, the model is fitted on the
+        non zero entries of data.
+
+    ftol : float, optional, default: 1e-8
+        a fit has converged when both the actual and the predicted relative
+        reductions of its objective are at most ftol.
+
+    xtol : float, optional, default: 1e-8
+        a fit has converged when the relative norm of its step is at most
+        xtol.
+
+    gtol : float, optional, default: 1e-8
+        a fit has converged when the cosine of the angle between its
+        residuals and the column of the jacobian of every parameter free to
+        move is at most gtol.
+
+    max_iter : integer, optional, default: 200
+        maximum number of iterations of each fit.
+
+    Returns
+    -------
+    results : ndarray (K, L + 3)
+        the fitted parameters
+
+    fvals : ndarray (K, )
+        the objective value of each fit
+
+    nfev : ndarray (K, )
+        the number of evaluations of the residuals of each fit
+
+    ier : ndarray (K, )
+        the convergence code of each fit, as in scipy.optimize.leastsq: 1 to
+        4 if it converged, 5 if it reached max_iter and 6 if no step reduced
+        its objective. A fit with no gaussian (a = 0), or with every
+        position on a chromosome end, has not converged: its code is -2.
+    """
+    if problem is None:
+        problem = FitProblem(data, lengths)
+    lower, upper = problem.bounds()
+    X = np.clip(np.array(inits, dtype=float), lower, upper)
+    n_batch, n_parameters = X.shape
+
+    residuals = problem.residuals_batch(X)
+    sum_squares = (residuals ** 2).sum(axis=1)
+    nfev = np.ones(n_batch, dtype=int)
+    damping = np.full(n_batch, 1e-3)
+    n_iter = np.zeros(n_batch, dtype=int)
+    ier = np.zeros(n_batch, dtype=int)
+    active = np.ones(n_batch, dtype=bool)
+
+    # Normal equations of each fit, only recomputed after accepted steps
+    hessian = np.empty((n_batch, n_parameters, n_parameters))
+    gradient = np.empty((n_batch, n_parameters))
+    outdated = np.ones(n_batch, dtype=bool)
+
+    while active.any():
+        update = np.flatnonzero(active & outdated)
+        if len(update):
+            jacobian = problem.jacobian_batch(X[update])
+            hessian[update] = np.matmul(jacobian,
+                                        jacobian.transpose((0, 2, 1)))
+            gradient[update] = np.matmul(
+                jacobian, residuals[update][..., np.newaxis])[..., 0]
+            outdated[update] = False
+            del jacobian
+
+        idx = np.flatnonzero(active)
+        small_gradient = _small_gradient(
+            hessian[idx], gradient[idx], X[idx], lower, upper,
+            sum_squares[idx], gtol)
+        ier[idx[small_gradient]] = 4
+        active[idx[small_gradient]] = False
+        idx = idx[~small_gradient]
+        if not len(idx):
+            break
+
+        trial, predicted = _bounded_steps(hessian[idx], gradient[idx],
+                                          X[idx], lower, upper, damping[idx])
+        step = trial - X[idx]
+        trial_residuals = problem.residuals_batch(trial)
+        trial_sum_squares = (trial_residuals ** 2).sum(axis=1)
+        nfev[idx] += 1
+        n_iter[idx] += 1
+
+        accepted = trial_sum_squares < sum_squares[idx]
+        scale = np.maximum(sum_squares[idx], 1e-300)
+        small_reduction = accepted & (
+            (sum_squares[idx] - trial_sum_squares) / scale <= ftol) & (
+            predicted / scale <= ftol)
+        small_step = accepted & (
+            np.sqrt((step ** 2).sum(axis=1)) <=
+            xtol * (xtol + np.sqrt((X[idx] ** 2).sum(axis=1))))
+
+        accept = idx[accepted]
+        X[accept] = trial[accepted]
+        residuals[accept] = trial_residuals[accepted]
+        sum_squares[accept] = trial_sum_squares[accepted]
+        outdated[accept] = True
+        damping[accept] = np.maximum(damping[accept] / 10, 1e-12)
+        damping[idx[~accepted]] *= 10
+
+        code = np.select(
+            [small_reduction & small_step, small_reduction, small_step,
+             damping[idx] > 1e12, n_iter[idx] >= max_iter],
+            [3, 1, 2, 6, 5], 0)
+        ier[idx] = code
+        active[idx[code > 0]] = False
+
+    ier[(ier <= 4) & _degenerate(X, lower, upper,
+                                 problem.n_chromosomes)] = -2
+    return X, problem.sum_of_squares(residuals), nfev, ier
@@ -1,53 +1,280 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 import itertools
+import os
+import time
 import numpy as np
 from scipy import ndimage
-from .optimization import fit_gaussian
-from .externals import iced
+from .optimization import fit_gaussian, fit_gaussian_batch, FitProblem
+from . import utils
+from .externals.joblib import Parallel, delayed, cpu_count
+from .externals.joblib import hashing, numpy_pickle
+from .externals.joblib.disk import memstr_to_kbytes, mkdirp
 
 
-def _detect_peaks(counts, lengths, sigma):
+def _detect_peaks(sum_trans):
     """
-    Detect peaks on sub_counts
-    """
-    peaks = []
-    scores = []
-    begin2, end2 = 0, 0
-    for l2 in lengths:
-        end2 += l2
-        subcounts = ndimage.gaussian_filter(
-            counts[:, begin2:end2], sigma)
-        counts[:, begin2:end2] = subcounts
-        begin2 = end2
+    Detect peaks on the smoothed trans marginal of a chromosome
 
-    sum_trans = counts.sum(axis=1)
+    A peak is a local maximum above the median of the marginal, or the
+    first bin if the marginal starts decreasing. Peaks are returned by
+    decreasing height, the first bin last.
+    """
     der = sum_trans[1:] - sum_trans[:-1]
 
     if len(der) == 0:
-        return peaks
+        return []
 
+    maxima = np.flatnonzero((der[1:] < 0) & (der[:-1] > 0) &
+                            (sum_trans[1:-1] > np.median(sum_trans))) + 1
+    peaks = maxima + 0.5
+    scores = - np.maximum(sum_trans[maxima - 1], sum_trans[maxima]) / 2
     if der[0] < 0:
-        peaks.append(0.5)
-        scores.append(sum_trans[0])
-
-    for i in range(1, len(der)):
-        if np.sign(der[i]) < 0 and (np.sign(der[i - 1]) > 0) and \
-           sum_trans[i] > np.median(sum_trans):
-            peaks.append(i + 0.5)
-            scores.append(- max(sum_trans[i - 1], sum_trans[i]) / 2)
+        peaks = np.concatenate([[0.5], peaks])
+        scores = np.concatenate([[sum_trans[0]], scores])
 
     # Sort by score
     if len(scores) > 1:
-        scores = np.array(scores)
-        indx = scores.argsort()
-        peaks = [peaks[i] for i in indx]
-    return peaks
+        peaks = peaks[scores.argsort()]
+    return peaks.tolist()
+
+
+def _persistent_peaks(sum_trans):
+    """
+    Local maxima of the trans marginal of a chromosome, by decreasing
+    persistence
+
+    The bins are added by decreasing height, and the connected components
+    of the bins added so far are tracked by a union-find: each component is
+    born at its highest bin, and dies when it merges with a component born
+    higher. The persistence of a maximum, the height between its birth and
+    its death, is its prominence. The highest maximum never dies: its
+    persistence is its height above the lowest bin. The sort makes the sweep
+    O(n log n).
+
+    Returns
+    -------
+    peaks, persistence : the maxima (bin + 0.5) and their persistence, by
+        decreasing persistence.
+    """
+    heights = sum_trans.tolist()
+    n = len(heights)
+    parent = [-1] * n
+    persistence = {}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in np.argsort(- sum_trans, kind="mergesort").tolist():
+        parent[i] = i
+        for j in (i - 1, i + 1):
+            if j < 0 or j >= n or parent[j] == -1:
+                continue
+            root_i, root_j = find(i), find(j)
+            if root_i == root_j:
+                continue
+            # The component born lower dies at the height of i
+            if heights[root_i] > heights[root_j]:
+                root_i, root_j = root_j, root_i
+            persistence[root_i] = heights[root_i] - heights[i]
+            parent[root_i] = root_j
+    if n:
+        persistence[find(0)] = max(heights) - min(heights)
+
+    maxima = np.array([i for i in persistence if persistence[i] > 0],
+                      dtype=int)
+    values = np.array([persistence[i] for i in maxima])
+    order = np.argsort(- values, kind="mergesort")
+    return (maxima[order] + 0.5).tolist(), values[order]
+
+
+class TransScaleSpace(object):
+    """
+    Trans contact marginals of each chromosome, smoothed at several sigmas
+
+    The marginal of a chromosome is the sum along the columns of its rows,
+    the first and last bins of every chromosome being set to 0. Smoothing
+    each chromosome block of these rows with a 2D gaussian filter and
+    summing along the columns gives the same marginal as smoothing the
+    marginal with a 1D gaussian filter: the filter is linear and, with
+    reflected boundaries, preserves the sums along the columns of each
+    block.
+
+    The marginals are computed once, and each smoothed marginal on its first
+    request. The scale space of a matrix can thus be shared by all the
+    candidate searches on it, whatever the chromosome and the number of
+    candidates. Each smoothed marginal kept costs an array of the length of
+    its chromosome.
+
+    Parameters
+    ----------
+    counts : ndarray n x n
+        Contact count matrix.
+
+    lengths : ndarray L
+        Length of each chromosome.
+
+    chromosomes : list of integers, optional, default: None
+        If provided, only the marginals of these chromosomes are computed,
+        only reading their rows of counts.
+
+    keep_smoothed : boolean, optional, default: True
+        whether to keep the smoothed marginals for the next requests. If
+        False, each request smooths the marginal again, and only the
+        marginals are kept.
+    """
+
+    def __init__(self, counts, lengths, chromosomes=None,
+                 keep_smoothed=True):
+        self.lengths = lengths.astype(int)
+        lencum = np.concatenate([[0], self.lengths.cumsum()])
+        self.begin, self.end = lencum[:-1], lencum[1:]
+        boundaries = np.concatenate([self.begin, self.end - 1])
+        columns = np.ones(counts.shape[1])
+        columns[boundaries] = 0
+        if chromosomes is None:
+            chromosomes = range(len(self.lengths))
+        self.marginal = np.zeros(self.lengths.sum())
+        for chromosome in chromosomes:
+            begin, end = self.begin[chromosome], self.end[chromosome]
+            self.marginal[begin:end] = counts[begin:end].dot(columns)
+        self.marginal[boundaries] = 0
+        self.keep_smoothed = keep_smoothed
+        self._smoothed = {}
+
+    def smoothed(self, chromosome, sigma):
+        """
+        Returns the trans marginal of chromosome smoothed at sigma
+
+        As with ndimage.gaussian_filter, a sigma of 0 or less doesn't smooth
+        the marginal.
+        """
+        key = (chromosome, sigma)
+        if key in self._smoothed:
+            return self._smoothed[key]
+        marginal = self.marginal[self.begin[chromosome]:self.end[chromosome]]
+        if sigma > 0:
+            smoothed = ndimage.gaussian_filter1d(marginal, sigma)
+        else:
+            smoothed = marginal.copy()
+        if self.keep_smoothed:
+            self._smoothed[key] = smoothed
+        return smoothed
+
+    def peaks(self, chromosome, sigma):
+        """
+        Returns the peaks of the trans marginal of chromosome smoothed at
+        sigma, by decreasing score
+        """
+        return _detect_peaks(self.smoothed(chromosome, sigma))
+
+
+def _bisect_sigma(detect, n_candidate, min_sigma, max_sigma, tol):
+    """
+    Bracketing and bisection search of the smallest sigma, within tol, at
+    which the marginal has at most n_candidate peaks.
+
+    The bracket is grown geometrically from sigma = 1, and then halved until
+    it is narrower than tol. If the upper end of the bracket has fewer than
+    n_candidate peaks, the lower end, which has more, is kept.
+
+    Returns
+    -------
+    peaks, sigma, n_passes : the peaks, the sigma at which they were
+        detected and the number of detection passes.
+    """
+    detected = {}
+
+    def n_peaks(sigma):
+        if sigma not in detected:
+            detected[sigma] = detect(sigma)
+        return len(detected[sigma])
+
+    high = min(max(1, min_sigma), max_sigma)
+    if n_peaks(high) > n_candidate:
+        low = high
+        while n_peaks(high) > n_candidate and high < max_sigma:
+            low, high = high, min(2 * high, max_sigma)
+        if n_peaks(high) > n_candidate:
+            return detected[high], high, len(detected)
+    else:
+        # min_sigma is above max_sigma on chromosomes shorter than it
+        low = min(min_sigma, high)
+        if low == high or n_peaks(low) <= n_candidate:
+            return detected[low], low, len(detected)
+
+    while high - low > tol:
+        middle = (low + high) / 2.
+        if n_peaks(middle) > n_candidate:
+            low = middle
+        else:
+            high = middle
+    sigma = high if n_peaks(high) >= n_candidate else low
+    n_peaks(sigma)
+    return detected[sigma], sigma, len(detected)
+
+
+def _chromosome_candidates(scale_space, chromosome, n_candidate=3,
+                           min_sigma=1, max_sigma=None, search="linear",
+                           tol=0.5):
+    """
+    Candidate centromeres of a single chromosome
+
+    Returns the candidates, the sigma at which they were detected and the
+    number of detection passes.
+    """
+    begin = scale_space.begin[chromosome]
+    length = scale_space.lengths[chromosome]
+    detect = lambda sigma: scale_space.peaks(chromosome, sigma)
+    if search == "persistence":
+        sigma, passes = min_sigma, 1
+        peaks, _ = _persistent_peaks(scale_space.smoothed(chromosome, sigma))
+        peaks = peaks[:n_candidate]
+    elif search == "bisection":
+        peaks, sigma, passes = _bisect_sigma(
+            detect, n_candidate, min_sigma,
+            length if max_sigma is None else max_sigma, tol)
+    else:
+        sigma = 1
+        peaks = detect(sigma)
+        passes = 1
+        while (len(peaks) > n_candidate) and (sigma < length):
+            sigma += 1
+            peaks = detect(sigma)
+            passes += 1
+
+        while len(peaks) < n_candidate and sigma >= min_sigma:
+            sigma -= 0.5
+            peaks = detect(sigma)
+            passes += 1
+
+    # If there is no peaks, set the peak to the middle of the
+    # centromere
+    if len(peaks) == 0:
+        peaks = [length / 2 + begin]
+    else:
+        peaks = [peak + begin for peak in peaks]
+    return peaks, sigma, passes
+
+
+def _memmapped_chromosome_candidates(counts, lengths, chromosome,
+                                     **parameters):
+    """
+    Candidate centromeres of a single chromosome, in a worker sharing counts
+    """
+    scale_space = TransScaleSpace(counts, lengths, chromosomes=[chromosome],
+                                  keep_smoothed=False)
+    return _chromosome_candidates(scale_space, chromosome, **parameters)
 
 
 def find_centromeres_candidates(counts, lengths, n_candidate=3,
                                 max_sigma=None, min_sigma=1, verbose=0,
-                                return_sigma=False):
+                                return_sigma=False, search="linear", tol=0.5,
+                                return_n_passes=False, scale_space=None,
+                                njobs=1):
     """
     Find approximate centromeres positions by detecting peaks in the marginal
     of trans contact counts.
@@ -67,7 +294,7 @@ def find_centromeres_candidates(counts, lengths, n_candidate=3,
         Maximum sigma to use. If None, is set to the chromosome length.
 
     min_sigma : float, optional, default : 1
-        Minimum sigma to use.
+        Minimum sigma to use. Should not be above max_sigma.
 
     verbose : boolean, optional, default: False
         Verbose level
@@ -75,58 +302,117 @@ def find_centromeres_candidates(counts, lengths, n_candidate=3,
     return_sigma : boolean, optional, default: False
         If set to true, returns the L sigma in addition of the peaks
 
+    search : string, optional, default: "linear"
+        how sigma is searched, "linear", "bisection" or "persistence".
+        "linear" increases sigma by 1 from 1 until there are at most
+        n_candidate peaks, and then decreases it by 0.5 until there are at
+        least n_candidate peaks. "bisection" brackets the smallest sigma with
+        at most n_candidate peaks and bisects the bracket down to tol, in a
+        logarithmic number of detection passes. "persistence" doesn't search
+        sigma: the candidates are the n_candidate most prominent maxima of
+        the marginal smoothed at min_sigma, found in a single pass.
+
+    tol : float, optional, default: 0.5
+        width of the final bracket of the bisection search. Should be
+        positive.
+
+    return_n_passes : boolean, optional, default: False
+        If set to true, also returns the number of detection passes of each
+        chromosome.
+
+    scale_space : TransScaleSpace, optional, default: None
+        precomputed scale space of counts. If provided, counts is ignored,
+        and, unless it was built with keep_smoothed=False, the smoothed
+        marginals computed by this search are kept in scale_space for the
+        next ones. Otherwise, only one smoothed marginal is held at a
+        time.
+
+    njobs : integer, optional, default: 1
+        number of worker processes searching the chromosomes. Each worker
+        computes the marginals of its chromosomes, reading counts from a
+        memory map shared by all the workers rather than from a pickled
+        copy. Ignored if scale_space is provided.
+
     Returns
     -------
     centromeres : a list of L list containing candidate centromeres for each
                   chromosome
     """
+    if search not in ("linear", "bisection", "persistence"):
+        raise ValueError("Unknown search %s" % search)
+    if tol <= 0:
+        raise ValueError("tol should be positive, got %s" % tol)
+    if max_sigma is not None and min_sigma > max_sigma:
+        raise ValueError("min_sigma %s should not be above max_sigma %s" % (
+            min_sigma, max_sigma))
     if verbose:
         print("Searching for centromeres candidates")
     # FIXME if there is more than 3 peaks ?
 
-    begin, end = 0, 0
-    centromeres_call = []
-    sigmas = []
-    lencum = np.concatenate([[0], lengths.cumsum().astype(int)])
+    search_parameters = dict(n_candidate=n_candidate, min_sigma=min_sigma,
+                             max_sigma=max_sigma, search=search, tol=tol)
+    if scale_space is None and njobs != 1:
+        results = Parallel(n_jobs=njobs, max_nbytes="1M", mmap_mode="r")(
+            delayed(_memmapped_chromosome_candidates)(
+                counts, lengths, chromosome, **search_parameters)
+            for chromosome in range(len(lengths)))
+    else:
+        if scale_space is None:
+            # Nothing outlives this search: keeping the smoothed marginals
+            # of every sigma visited would only cost memory
+            scale_space = TransScaleSpace(counts, lengths,
+                                          keep_smoothed=False)
+        results = [_chromosome_candidates(scale_space, chromosome,
+                                          **search_parameters)
+                   for chromosome in range(len(scale_space.lengths))]
+    centromeres_call, sigmas, n_passes = [list(r) for r in zip(*results)]
+    if verbose > 1:
+        print("Detection passes per chromosome: %s" % n_passes)
+    results = (centromeres_call, )
+    if return_sigma:
+        results += (sigmas, )
+    if return_n_passes:
+        results += (n_passes, )
+    return results[0] if len(results) == 1 else results
 
-    counts = counts.copy()
-    counts[:, lencum[:-1]] = 0
-    counts[lencum[:-1]] = 0
-    counts[:, lencum[1:] - 1] = 0
-    counts[lencum[1:] - 1] = 0
 
-    for length in lengths.astype(int):
-        end += length
-        sigma = 1
-        max_sigma = length
-        gf_counts = counts[begin:end]
-        peaks = _detect_peaks(gf_counts.copy(), lengths, sigma)
-        while (len(peaks) > n_candidate) and (sigma < max_sigma):
-            sigma += 1
-            gf_counts = counts[begin:end].copy()
-            peaks = _detect_peaks(gf_counts.copy(), lengths, sigma)
+def _chunk_size(n_items, njobs, multiple=1):
+    """
+    Size of the chunks splitting n_items across njobs worker processes
 
-        while len(peaks) < n_candidate and sigma >= min_sigma:
-            sigma -= 0.5
-            gf_counts = counts[begin:end].copy()
-            peaks = _detect_peaks(gf_counts.copy(), lengths, sigma)
+    As in joblib, a negative njobs counts the workers back from the number of
+    CPUs. Each worker gets about four chunks, whose size is rounded up to a
+    multiple of multiple.
+    """
+    n_workers = njobs if njobs > 0 else max(cpu_count() + 1 + njobs, 1)
+    chunk_size = max(1, -(-n_items // (4 * n_workers)))
+    return multiple * -(-chunk_size // multiple)
 
-        # If there is no peaks, set the peak to the middle of the
-        # centromere
-        if len(peaks) == 0:
-            peaks = [length / 2 + begin]
-        else:
-            peaks = [peak + begin for peak in peaks]
-        centromeres_call.append(peaks)
-        sigmas.append(sigma)
-        begin = end
-    if return_sigma:
-        return centromeres_call, sigmas
-    return centromeres_call
+
+def _fit_alternatives(counts, lengths, baseline_results, alternatives,
+                      problem=None, symmetric=False, **fit_parameters):
+    """
+    Objective value of the fit from the baseline results, with the position
+    of one chromosome replaced, for each (chromosome, position) of
+    alternatives
+    """
+    if problem is None:
+        problem = FitProblem(counts, lengths, symmetric=symmetric)
+    obj_values = []
+    for num, candidate in alternatives:
+        parameters = baseline_results.copy()
+        parameters[num] = candidate
+        results, _, _, _, _ = fit_gaussian(
+            counts, parameters, lengths, problem=problem,
+            factor=10, xtol=0.5, **fit_parameters)
+        obj_values.append(problem.objective(results))
+    return obj_values
 
 
 def filter_centromeres_candidates(counts, lengths, candidates, copy=True,
-                                  sigma=4, verbose=0):
+                                  sigma=4, verbose=0, solver="leastsq",
+                                  symmetric=False, variable_projection=False,
+                                  njobs=1):
     """
     Filter centromeres candidates using a set of heuristics.
 
@@ -150,6 +436,22 @@ def filter_centromeres_candidates(counts, lengths, candidates, copy=True,
     verbose : boolean, optional, default: False
         Verbose level
 
+    solver : {"leastsq", "trf", "structured"}, optional, default: "leastsq"
+        solver used to fit the gaussians. See fit_gaussian.
+
+    symmetric : boolean, optional, default: False
+        whether counts is symmetric. If True, the fits and their objective
+        values only use the upper triangle, at half the cost.
+
+    variable_projection : boolean, optional, default: False
+        whether to solve for the amplitude and baseline in closed form inside
+        each fit. See fit_gaussian.
+
+    njobs : integer, optional, default: 1
+        number of worker processes fitting the alternative candidates. The
+        masked counts are shared with the workers as a read-only memory map.
+        The kept candidates are the same as with a single process.
+
     Returns
     -------
     candidates : a list of L list containing the reduced candidate centromeres
@@ -162,56 +464,341 @@ def filter_centromeres_candidates(counts, lengths, candidates, copy=True,
     if copy:
         counts = counts.copy()
     baseline_candidates = [c[0] for c in candidates]
-    mask = iced.utils.get_intra_mask(lengths)
-    counts[mask] = 0
-    parameters = np.concatenate([baseline_candidates,
-                                 [counts.max() - np.median(counts),
-                                  np.median(counts),
-                                  sigma]])
-
-    baseline_results, _, infodict, _, _ = fit_gaussian(
-        counts, parameters, lengths, counts=True,
-        factor=10, xtol=0.01)
-    baseline = ((counts.flatten() - infodict["fvec"]) ** 2).sum()
+    utils.mask_intra_counts(counts, lengths)
+    problem = FitProblem(counts, lengths, symmetric=symmetric)
+    parameters = problem.initial_parameters(baseline_candidates, sigma)
+
+    baseline_results, _, _, _, _ = fit_gaussian(
+        counts, parameters, lengths, problem=problem,
+        factor=10, xtol=0.01, solver=solver,
+        variable_projection=variable_projection)
+    baseline = problem.objective(baseline_results)
 
     all_candidates = [[i, g] for i, cent in enumerate(candidates)
                       for j, g in enumerate(cent) if j != 0]
 
     kept_candidates = [[cent] for cent in baseline_results[:len(lengths)]]
 
-    for num, candidate in all_candidates:
-        parameters = baseline_results.copy()
-        parameters[num] = candidate
-        results, _, infodict, _, _ = fit_gaussian(
-            counts, parameters, lengths, counts=True,
-            factor=10, xtol=0.5)
+    options = dict(solver=solver, variable_projection=variable_projection)
+    if njobs == 1:
+        obj_values = _fit_alternatives(counts, lengths, baseline_results,
+                                       all_candidates, problem=problem,
+                                       **options)
+    else:
+        chunk_size = _chunk_size(len(all_candidates), njobs)
+        chunks = Parallel(n_jobs=njobs, max_nbytes="1M", mmap_mode="r")(
+            delayed(_fit_alternatives)(
+                counts, lengths, baseline_results,
+                all_candidates[start:start + chunk_size],
+                symmetric=symmetric, **options)
+            for start in range(0, len(all_candidates), chunk_size))
+        obj_values = list(itertools.chain(*chunks))
 
-        obj_value = ((counts.flatten() - infodict["fvec"]) ** 2).sum()
+    for (num, candidate), obj_value in zip(all_candidates, obj_values):
         if obj_value <= baseline:
             kept_candidates[num].append(candidate)
     return kept_candidates
 
 
-def refine_centromeres(counts, lengths, candidate, sigma=4, verbose=0):
+def refine_centromeres(counts, lengths, candidate, sigma=4, verbose=0,
+                       problem=None, solver="leastsq",
+                       variable_projection=False, sigma_schedule=None,
+                       return_n_evaluations=False, abandon_above=None,
+                       abandon_after=10):
     """
     A single run of the optimization, assuming all preparation is complete
+
+    If provided, problem is the FitProblem of counts, shared across runs.
+    solver and variable_projection are passed to fit_gaussian.
+
+    If provided, sigma_schedule is a decreasing sequence of sigmas: the model
+    is first fitted from the widest sigma with cheap tolerances, and each
+    following stage, and finally the fit from sigma, is warm started from the
+    results of the previous one. If return_n_evaluations is True, the number
+    of evaluations of each stage is also returned.
+
+    If provided, the fit from sigma is abandoned once its objective is still
+    above abandon_above after abandon_after evaluations, and the objective
+    value returned is then inf.
     """
-    parameters = np.concatenate(
-        [candidate,
-         [counts.max() - np.median(counts),
-          np.median(counts),
-          sigma]])
+    if problem is None:
+        problem = FitProblem(counts, lengths)
+    stages = [] if sigma_schedule is None else list(sigma_schedule)
+    parameters = problem.initial_parameters(
+        candidate, stages[0] if stages else sigma)
+    n_evaluations = []
+    for stage_sigma in stages:
+        parameters[-1] = stage_sigma
+        parameters, _, infodict, _, _ = fit_gaussian(
+            counts, parameters, lengths, problem=problem, factor=10,
+            ftol=1e-3, gtol=1e-3, xtol=1e-3, solver=solver,
+            variable_projection=variable_projection)
+        n_evaluations.append(infodict["nfev"])
+        if verbose > 1:
+            print("Stage sigma=%g: %d evaluations" % (
+                stage_sigma, infodict["nfev"]))
+    parameters[-1] = sigma
     results, cov_x, infodict, mesg, suc = fit_gaussian(
-        counts, parameters, lengths, counts=True,
-        factor=10)
-    fval = ((counts.flatten() - infodict["fvec"]) ** 2).sum()
+        counts, parameters, lengths, problem=problem,
+        factor=10, solver=solver, variable_projection=variable_projection,
+        abandon_above=abandon_above, abandon_after=abandon_after)
+    n_evaluations.append(infodict["nfev"])
+    if suc == -1:
+        if verbose > 1:
+            print(mesg)
+        fval = np.inf
+    else:
+        fval = problem.objective(results)
     best_results = results[:len(lengths)] + 0.5
+    if return_n_evaluations:
+        return fval, best_results, n_evaluations
     return fval, best_results
 
 
+class FitCache(object):
+    """
+    On-disk cache of the fits of refine_centromeres
+
+    Each fit is stored in its own file, under a fingerprint of the problem
+    and a hash of the candidate. Once the files take more than bytes_limit,
+    the least recently used ones are removed. The cache can be shared by
+    several processes.
+
+    Parameters
+    ----------
+    cachedir : string
+        directory of the cache.
+
+    bytes_limit : integer or string, optional, default: "100M"
+        size limit of the cache, in bytes or as a string such as "100M".
+    """
+
+    def __init__(self, cachedir, bytes_limit="100M"):
+        self.cachedir = cachedir
+        if isinstance(bytes_limit, str):
+            bytes_limit = 1024 * memstr_to_kbytes(bytes_limit)
+        self.bytes_limit = bytes_limit
+        self._size = None
+        mkdirp(cachedir)
+
+    def fingerprint(self, counts, lengths, **settings):
+        """
+        Returns the fingerprint of the fits of counts with settings
+        """
+        return hashing.hash((counts, lengths, sorted(settings.items())),
+                            coerce_mmap=True)
+
+    def _filename(self, fingerprint, candidate):
+        key = hashing.hash([float(c) for c in candidate])
+        return os.path.join(self.cachedir, fingerprint, key + ".pkl")
+
+    def get(self, fingerprint, candidate):
+        """
+        Returns the objective value and positions of the fit of candidate,
+        or None if it isn't in the cache
+        """
+        filename = self._filename(fingerprint, candidate)
+        try:
+            fval, results = numpy_pickle.load(filename)
+            # The modification time orders the entries for the eviction
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        return fval, results
+
+    def set(self, fingerprint, candidate, fval, results):
+        """
+        Stores the objective value and positions of the fit of candidate
+        """
+        filename = self._filename(fingerprint, candidate)
+        mkdirp(os.path.dirname(filename))
+        # Written aside and renamed, so that other processes never read a
+        # partial entry
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        numpy_pickle.dump((fval, results), tmp_filename, compress=1)
+        try:
+            os.rename(tmp_filename, filename)
+        except OSError:
+            # Already written by another process
+            os.remove(tmp_filename)
+            return
+        if self._size is None:
+            self.reduce_size()
+        else:
+            self._size += os.path.getsize(filename)
+            if self._size > self.bytes_limit:
+                self.reduce_size()
+
+    def reduce_size(self):
+        """
+        Removes the least recently used entries beyond bytes_limit
+        """
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cachedir):
+            for filename in filenames:
+                if not filename.endswith(".pkl"):
+                    continue
+                filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if self._size <= self.bytes_limit:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self._size -= size
+
+
+def _refine_cached(counts, lengths, candidate, cache=None, fingerprint=None,
+                   **kwargs):
+    """
+    refine_centromeres, reading and storing the fits in cache
+
+    Abandoned fits aren't stored.
+
+    Returns
+    -------
+    fval, results, nfev, cached : the objective value and positions of the
+        fit, the number of evaluations of its last stage, and whether it was
+        read from the cache.
+    """
+    if cache is not None:
+        entry = cache.get(fingerprint, candidate)
+        if entry is not None:
+            return entry[0], entry[1], 0, True
+    fval, results, n_evaluations = refine_centromeres(
+        counts, lengths, candidate, return_n_evaluations=True, **kwargs)
+    if cache is not None and not np.isinf(fval):
+        cache.set(fingerprint, candidate, fval, results)
+    return fval, results, n_evaluations[-1], False
+
+
+def _refine_candidates(counts, lengths, candidates, start=0,
+                       n_candidates=None, problem=None, sigma=4, verbose=0,
+                       batch_size=None, symmetric=False, abandon_margin=None,
+                       deadline=None, cache=None, fingerprint=None,
+                       **fit_parameters):
+    """
+    Fit every candidate, numbered from start in the enumeration order, and
+    keep the best one
+
+    If provided, the fits are abandoned once their objective is still above
+    (1 + abandon_margin) times the lowest objective value so far. This is
+    ignored with batch_size.
+
+    If provided, no fit is started after the time deadline, in seconds since
+    the epoch, except for the first candidate when start is 0.
+
+    If provided, the fits are read from and stored in cache, under
+    fingerprint. This is ignored with batch_size.
+
+    Returns
+    -------
+    fval_min, index, best_results, n_fits, elapsed, pid : the lowest
+        objective value, the number of the first candidate reaching it and
+        its fitted positions, the number of fits, their running time and the
+        process which ran them.
+
+    n_abandoned, nfev, nfev_abandoned, n_cached : the number of fits
+        abandoned, the number of evaluations of all the fits and of the
+        abandoned ones, and the number of fits read from the cache.
+
+    n_unconverged : the number of batched fits which did not converge.
+    """
+    t0 = time.time()
+    if problem is None:
+        problem = FitProblem(counts, lengths, symmetric=symmetric)
+    fval_min, index, best_results = None, None, None
+    n_fits = n_abandoned = nfev = nfev_abandoned = n_cached = 0
+    n_unconverged = 0
+    if batch_size is not None:
+        candidates = iter(candidates)
+        while True:
+            batch = list(itertools.islice(candidates, batch_size))
+            if not batch or _out_of_budget(start + n_fits, None, deadline):
+                break
+            if verbose:
+                print("Computing %d - %d / %d candidates" % (
+                    start + n_fits + 1, start + n_fits + len(batch),
+                    n_candidates))
+            inits = [problem.initial_parameters(c, sigma) for c in batch]
+            results, fvals, _, ier = fit_gaussian_batch(
+                counts, inits, lengths, problem=problem)
+            n_unconverged += ((ier < 1) | (ier > 4)).sum()
+            # argmin keeps the first of equal candidates
+            best = fvals.argmin()
+            if fval_min is None or fvals[best] < fval_min:
+                fval_min = fvals[best]
+                index = start + n_fits + best
+                best_results = results[best, :len(lengths)] + 0.5
+            n_fits += len(batch)
+    else:
+        for c in candidates:
+            if _out_of_budget(start + n_fits, None, deadline):
+                break
+            if verbose:
+                print("Computing %d / %d candidates" % (
+                    start + n_fits + 1, n_candidates))
+            abandon_above = None
+            if abandon_margin is not None and fval_min is not None:
+                abandon_above = fval_min * (1 + abandon_margin)
+            fval, results, n_evaluations, cached = _refine_cached(
+                counts, lengths, c, cache=cache, fingerprint=fingerprint,
+                sigma=sigma, verbose=verbose, problem=problem,
+                abandon_above=abandon_above, **fit_parameters)
+            nfev += n_evaluations
+            n_cached += cached
+            if np.isinf(fval):
+                n_abandoned += 1
+                nfev_abandoned += n_evaluations
+            elif fval_min is None or fval < fval_min:
+                fval_min, index, best_results = fval, start + n_fits, results
+            n_fits += 1
+    return (fval_min, index, best_results, n_fits, time.time() - t0,
+            os.getpid(), n_abandoned, nfev, nfev_abandoned, n_cached,
+            n_unconverged)
+
+
+def _out_of_budget(n_fits, max_fits=None, deadline=None):
+    """
+    Whether a search which ran n_fits fits is out of its budget
+
+    At least one fit is always run.
+    """
+    if not n_fits:
+        return False
+    return ((max_fits is not None and n_fits >= max_fits) or
+            (deadline is not None and time.time() >= deadline))
+
+
+def _evaluations_saved(n_fits, n_abandoned, nfev, nfev_abandoned):
+    """
+    Estimate the number of evaluations saved by abandoning fits
+
+    Each abandoned fit is assumed to have needed the mean number of
+    evaluations of the fits run to completion.
+    """
+    if not n_abandoned or n_abandoned == n_fits:
+        return 0
+    mean_nfev = (nfev - nfev_abandoned) / float(n_fits - n_abandoned)
+    return max(int(round(n_abandoned * mean_nfev - nfev_abandoned)), 0)
+
+
 def optimize_centromeres(counts, lengths, candidates, sigma=4, verbose=0,
                          njobs=1,
-                         copy=True):
+                         copy=True, solver="leastsq", batch_size=None,
+                         symmetric=False, variable_projection=False,
+                         sigma_schedule=None, return_stats=False,
+                         search="exhaustive", beam_width=4, max_fits=None,
+                         max_time=None, abandon_margin=None,
+                         abandon_after=10, cache=None):
     """
     Perform the optimization steps of finding centromeres given a certain
     number of candidates.
@@ -227,13 +814,103 @@ def optimize_centromeres(counts, lengths, candidates, sigma=4, verbose=0,
     candidates : list of L liste
         list of candidates
 
+    njobs : integer, optional, default: 1
+        number of worker processes fitting the candidates. The candidates
+        are split in consecutive chunks, and the masked counts are shared
+        with the workers as a read-only memory map. The best candidate is
+        the same as with a single process: ties are broken by the
+        enumeration order.
+
     copy : boolean, optional, default: True
         whether to copy the contact counts matrix
 
     sigma : float, optional, default: 4
         initialization of the sigma parameters of the gaussians
 
+    solver : {"leastsq", "trf", "structured"}, optional, default: "leastsq"
+        solver used to fit the gaussians. See fit_gaussian.
+
+    batch_size : integer, optional, default: None
+        If provided, the candidates are fitted batch_size at a time with
+        fit_gaussian_batch, and solver, variable_projection and
+        sigma_schedule are ignored. Larger batches amortize the per call
+        overhead, at the cost of a jacobian of batch_size x (L + 3) x
+        n_contacts. The statistics then also report the number of fits
+        which did not converge ("n_unconverged"), and the result isn't
+        optimal if there are any.
+
+    symmetric : boolean, optional, default: False
+        whether counts is symmetric. If True, the fits and their objective
+        values only use the upper triangle, at half the cost.
+
+    variable_projection : boolean, optional, default: False
+        whether to solve for the amplitude and baseline in closed form inside
+        each fit. See fit_gaussian.
+
+    sigma_schedule : sequence of floats, optional, default: None
+        If provided, each candidate is fitted by continuation, from the
+        widest sigma of sigma_schedule down to sigma. See refine_centromeres.
+
+    return_stats : boolean, optional, default: False
+        If set to true, also returns a dictionary of statistics of the
+        search: the objective value ("fval") and the number ("index") of the
+        best candidate, the number of fits ("n_fits"), whether max_fits or
+        max_time was reached ("budget_exhausted"), the fraction of the
+        combinations of candidates fitted, or pruned by the beam search
+        ("completed_fraction"), and whether the result is the best fit of
+        all the combinations ("optimal"). The exhaustive search also reports,
+        for each worker process, its number of fits, running time and
+        throughput in fits per second ("workers").
+
+    search : string, optional, default: "exhaustive"
+        "exhaustive", "coordinate" or "beam". "exhaustive" fits every
+        combination of candidates. "coordinate" is a coordinate descent, which
+        changes the candidate of one chromosome at a time, warm started from
+        the best fit so far, until a sweep over all the chromosomes changes
+        nothing: it takes about sum(len(c)) x n_sweeps fits instead of
+        prod(len(c)). Its statistics also include the number of sweeps
+        ("n_sweeps"), and it ignores njobs, batch_size and sigma_schedule.
+        "beam" assigns the chromosomes one at a time, and only keeps the
+        beam_width partial assignments with the lowest objective before any
+        fit, the amplitude and baseline being solved in closed form. Only the
+        complete assignments left are fitted. Its statistics also include the
+        number of assignments scored ("n_scored"), the number of combinations
+        pruned without a fit ("n_pruned") and their fraction
+        ("pruned_fraction"), and it ignores njobs and batch_size.
 
+    beam_width : integer, optional, default: 4
+        number of partial assignments kept by the beam search.
+
+    max_fits, max_time : integer and float, optional, default: None
+        maximum number of fits and running time in seconds of the search.
+        No fit is started once either is reached, and the best fit so far
+        is returned. At least one fit is always run, and the fits running
+        at the deadline are completed. The exhaustive search fits the first
+        max_fits combinations in the enumeration order.
+
+    abandon_margin : float, optional, default: None
+        If provided, a fit is abandoned when, after abandon_after
+        evaluations, its objective is still above (1 + abandon_margin) times
+        the best objective value so far. With njobs, the best value is the
+        one of each chunk of candidates. batch_size ignores it. The
+        objective of an abandoned fit could still have ended below the best
+        one: larger margins abandon fewer fits. The statistics then also
+        report the number of fits abandoned ("n_abandoned") and an estimate
+        of the number of evaluations saved ("evaluations_saved"), assuming
+        each abandoned fit would have taken the mean number of evaluations
+        of the fits run to completion.
+
+    abandon_after : integer, optional, default: 10
+        number of evaluations before a fit can be abandoned.
+
+    cache : string or FitCache, optional, default: None
+        If provided, a FitCache, or the directory of one, storing the fits of
+        the exhaustive and beam searches. The fits of the same candidates,
+        on the same masked counts, with the same sigma and solver settings,
+        are then read from the cache rather than run again, across calls.
+        The statistics then also report the number of fits read from the
+        cache ("n_cached"), which are included in "n_fits". The coordinate
+        search, whose fits are warm started, and batch_size ignore it.
     """
     if verbose:
         print("Refining centromeres calls.")
@@ -241,27 +918,305 @@ def optimize_centromeres(counts, lengths, candidates, sigma=4, verbose=0,
     if copy:
         counts = counts.copy()
 
-    mask = iced.utils.get_intra_mask(lengths)
-    counts[mask] = 0
+    utils.mask_intra_counts(counts, lengths)
+
+    fingerprint = None
+    if cache is not None:
+        if not isinstance(cache, FitCache):
+            cache = FitCache(cache)
+        fingerprint = cache.fingerprint(
+            counts, lengths, sigma=float(sigma), solver=solver,
+            symmetric=symmetric, variable_projection=variable_projection,
+            sigma_schedule=(None if sigma_schedule is None else
+                            [float(s) for s in sigma_schedule]))
 
-    all_candidates = itertools.product(
-        *[candidate for candidate in candidates])
+    if search == "coordinate":
+        best_results, stats = _coordinate_search(
+            counts, lengths, candidates, sigma=sigma, verbose=verbose,
+            max_fits=max_fits, max_time=max_time, symmetric=symmetric,
+            abandon_margin=abandon_margin, abandon_after=abandon_after,
+            solver=solver, variable_projection=variable_projection)
+    elif search == "beam":
+        best_results, stats = _beam_search(
+            counts, lengths, candidates, sigma=sigma, verbose=verbose,
+            beam_width=beam_width, max_fits=max_fits, max_time=max_time,
+            symmetric=symmetric, abandon_margin=abandon_margin,
+            abandon_after=abandon_after, cache=cache,
+            fingerprint=fingerprint, solver=solver,
+            variable_projection=variable_projection,
+            sigma_schedule=sigma_schedule)
+    elif search == "exhaustive":
+        best_results, stats = _exhaustive_search(
+            counts, lengths, candidates, sigma=sigma, verbose=verbose,
+            njobs=njobs, max_fits=max_fits, max_time=max_time,
+            batch_size=batch_size, symmetric=symmetric,
+            abandon_margin=abandon_margin, abandon_after=abandon_after,
+            cache=cache, fingerprint=fingerprint, solver=solver,
+            variable_projection=variable_projection,
+            sigma_schedule=sigma_schedule)
+    else:
+        raise ValueError("Unknown search %s" % search)
 
+    if return_stats:
+        return best_results, stats
+    return best_results
+
+
+def _exhaustive_search(counts, lengths, candidates, sigma=4, verbose=0,
+                       njobs=1, max_fits=None, max_time=None, **options):
+    """
+    Fit every combination of candidates, and keep the best one
+
+    Returns the positions of the best fit and the statistics of
+    optimize_centromeres.
+    """
+    n_candidates = int(np.prod([len(j) for j in candidates]))
+    n_total = n_candidates if max_fits is None else min(n_candidates,
+                                                         max_fits)
+    all_candidates = itertools.islice(
+        itertools.product(*[candidate for candidate in candidates]), n_total)
     if verbose:
-        print("%d candidates" % np.prod([len(c) for c in candidates]))
-        print
+        print("%d candidates" % n_candidates)
 
-    fval_min = None
-    best_results = None
-    for i, c in enumerate(all_candidates):
+    options["sigma"] = sigma
+    if max_time is not None:
+        options["deadline"] = time.time() + max_time
+    batch_size = options.get("batch_size")
+    if njobs == 1:
+        chunks = [_refine_candidates(counts, lengths, all_candidates,
+                                     n_candidates=n_candidates,
+                                     verbose=verbose, **options)]
+    else:
+        chunk_size = _chunk_size(n_total, njobs, multiple=batch_size or 1)
+        chunks = Parallel(n_jobs=njobs, max_nbytes="1M", mmap_mode="r")(
+            delayed(_refine_candidates)(
+                counts, lengths,
+                list(itertools.islice(all_candidates, chunk_size)),
+                start=start, n_candidates=n_candidates, **options)
+            for start in range(0, n_total, chunk_size))
+
+    # The chunks come back in enumeration order: keeping the first of equal
+    # objective values gives the same candidate as a single process.
+    fval_min, index, best_results = None, None, None
+    workers = {}
+    n_abandoned = nfev = nfev_abandoned = n_cached = n_unconverged = 0
+    for (fval, i, results, n_fits, elapsed, pid, chunk_abandoned,
+         chunk_nfev, chunk_nfev_abandoned, chunk_cached,
+         chunk_unconverged) in chunks:
+        if fval is not None and (fval_min is None or fval < fval_min):
+            fval_min, index, best_results = fval, i, results
+        worker = workers.setdefault(pid, {"n_fits": 0, "time": 0.})
+        worker["n_fits"] += n_fits
+        worker["time"] += elapsed
+        n_abandoned += chunk_abandoned
+        nfev += chunk_nfev
+        nfev_abandoned += chunk_nfev_abandoned
+        n_cached += chunk_cached
+        n_unconverged += chunk_unconverged
+    for pid, worker in workers.items():
+        worker["throughput"] = worker["n_fits"] / max(worker["time"], 1e-12)
         if verbose:
-            print("Computing %d / %d candidates" % (
-                i + 1, np.prod([len(j) for j in candidates])))
-        fval, results = refine_centromeres(
-            counts, lengths, c,
-            sigma=sigma, verbose=verbose)
-        if fval < fval_min or fval_min is None:
-            fval_min = fval
-            best_results = results
+            print("Worker %d: %d fits in %.2fs, %.2f fits/s" % (
+                pid, worker["n_fits"], worker["time"],
+                worker["throughput"]))
 
-    return best_results
+    n_fits = sum(w["n_fits"] for w in workers.values())
+    stats = {"fval": fval_min, "index": index, "n_fits": n_fits,
+             "budget_exhausted": n_fits < n_candidates,
+             "completed_fraction": n_fits / float(n_candidates),
+             "optimal": (n_fits == n_candidates and not n_abandoned and
+                         not n_unconverged),
+             "workers": workers, "n_abandoned": n_abandoned,
+             "evaluations_saved": _evaluations_saved(
+                 n_fits - n_cached, n_abandoned, nfev, nfev_abandoned),
+             "n_cached": n_cached}
+    if options.get("batch_size") is not None:
+        stats["n_unconverged"] = int(n_unconverged)
+    return best_results, stats
+
+
+def _coordinate_search(counts, lengths, candidates, sigma=4, verbose=0,
+                       max_fits=None, max_time=None, symmetric=False,
+                       abandon_margin=None, abandon_after=10,
+                       **fit_parameters):
+    """
+    Coordinate descent over the candidates of each chromosome
+
+    Starting from the first candidate of every chromosome, each sweep tries
+    the other candidates of one chromosome at a time, warm started from the
+    best parameters so far, and keeps any that lowers the objective. The
+    sweeps stop when one of them changes nothing, or after max_fits fits or
+    max_time seconds. Combinations already fitted are not fitted again.
+
+    Returns the positions of the best fit and the statistics of
+    optimize_centromeres.
+    """
+    deadline = None if max_time is None else time.time() + max_time
+    problem = FitProblem(counts, lengths, symmetric=symmetric)
+    n_chromosomes = len(lengths)
+    choice = [0] * n_chromosomes
+    parameters, _, infodict, _, _ = fit_gaussian(
+        counts, problem.initial_parameters([c[0] for c in candidates], sigma),
+        lengths, problem=problem, factor=10, **fit_parameters)
+    fval_min = problem.objective(parameters)
+    n_abandoned, nfev, nfev_abandoned = 0, infodict["nfev"], 0
+    fitted = set([tuple(choice)])
+    n_sweeps = 0
+    changed = True
+    budget_exhausted = False
+    while changed and not budget_exhausted:
+        changed = False
+        n_sweeps += 1
+        for num, chromosome_candidates in enumerate(candidates):
+            for j, candidate in enumerate(chromosome_candidates):
+                trial = tuple(choice[:num] + [j] + choice[num + 1:])
+                if trial in fitted:
+                    continue
+                if _out_of_budget(len(fitted), max_fits, deadline):
+                    budget_exhausted = True
+                    break
+                fitted.add(trial)
+                init = parameters.copy()
+                init[num] = candidate
+                abandon_above = None
+                if abandon_margin is not None:
+                    abandon_above = fval_min * (1 + abandon_margin)
+                results, _, infodict, _, ier = fit_gaussian(
+                    counts, init, lengths, problem=problem, factor=10,
+                    abandon_above=abandon_above, abandon_after=abandon_after,
+                    **fit_parameters)
+                nfev += infodict["nfev"]
+                if ier == -1:
+                    n_abandoned += 1
+                    nfev_abandoned += infodict["nfev"]
+                    continue
+                fval = problem.objective(results)
+                if fval < fval_min:
+                    fval_min, parameters = fval, results
+                    choice = list(trial)
+                    changed = True
+            if budget_exhausted:
+                break
+        if verbose:
+            print("Sweep %d: %d fits, objective %f" % (
+                n_sweeps, len(fitted), fval_min))
+
+    # The descent is local: a converged descent doesn't rule out the
+    # combinations it did not fit
+    n_candidates = int(np.prod([len(c) for c in candidates]))
+    stats = {"fval": fval_min,
+             "index": int(np.ravel_multi_index(
+                 choice, [len(c) for c in candidates])),
+             "n_fits": len(fitted), "n_sweeps": n_sweeps,
+             "budget_exhausted": budget_exhausted,
+             "completed_fraction": len(fitted) / float(n_candidates),
+             "optimal": len(fitted) == n_candidates and not n_abandoned,
+             "n_abandoned": n_abandoned,
+             "evaluations_saved": _evaluations_saved(
+                 len(fitted), n_abandoned, nfev, nfev_abandoned)}
+    return parameters[:n_chromosomes] + 0.5, stats
+
+
+def _beam_search(counts, lengths, candidates, sigma=4, verbose=0,
+                 beam_width=4, max_fits=None, max_time=None, symmetric=False,
+                 abandon_margin=None, abandon_after=10, cache=None,
+                 fingerprint=None, **fit_parameters):
+    """
+    Beam search over the candidates of each chromosome
+
+    The chromosomes are assigned in order. Each partial assignment is scored
+    by the objective of the unfitted model, the unassigned chromosomes
+    taking their first candidate, with the amplitude and baseline solved in
+    closed form. Only the beam_width best partial assignments are extended
+    to the next chromosome. The complete assignments left are fitted by
+    increasing score, until max_fits fits or max_time seconds, at least one
+    fit being always run.
+
+    The score is the objective at the start of a fit, which upper bounds the
+    objective after the fit: the pruning is a heuristic, and the best
+    combination may be pruned.
+
+    Returns the positions of the best fit and the statistics of
+    optimize_centromeres.
+    """
+    deadline = None if max_time is None else time.time() + max_time
+    problem = FitProblem(counts, lengths, symmetric=symmetric)
+    sizes = [len(c) for c in candidates]
+    n_chromosomes = len(lengths)
+    scores = {}
+
+    def score(choice):
+        choice = choice + (0, ) * (n_chromosomes - len(choice))
+        if choice not in scores:
+            positions = np.array([candidates[num][j]
+                                  for num, j in enumerate(choice)],
+                                 dtype=float)
+            a, b = problem.linear_parameters(positions, sigma)
+            scores[choice] = problem.objective(
+                np.concatenate([positions, [a, b, sigma]]))
+        return scores[choice]
+
+    beam = [()]
+    n_pruned = n_unsearched = 0
+    budget_exhausted = False
+    for num in range(n_chromosomes):
+        children = [parent + (j, ) for parent in beam
+                    for j in range(sizes[num])]
+        children.sort(key=score)
+        beam = children[:beam_width]
+        n_pruned += (len(children) - len(beam)) * int(
+            np.prod(sizes[num + 1:]))
+        if (num < n_chromosomes - 1 and deadline is not None and
+                time.time() >= deadline):
+            # Out of time: the unassigned chromosomes keep their first
+            # candidate
+            n_unsearched = len(beam) * (int(np.prod(sizes[num + 1:])) - 1)
+            n_pruned += n_unsearched
+            beam = [choice + (0, ) * (n_chromosomes - len(choice))
+                    for choice in beam]
+            budget_exhausted = True
+            break
+    if verbose:
+        print("Beam search: %d assignments scored, %d combinations pruned" % (
+            len(scores), n_pruned))
+
+    fval_min, choice_min, best_results = None, None, None
+    n_fits = n_abandoned = nfev = nfev_abandoned = n_cached = 0
+    for choice in beam:
+        if _out_of_budget(n_fits, max_fits, deadline):
+            budget_exhausted = True
+            break
+        abandon_above = None
+        if abandon_margin is not None and fval_min is not None:
+            abandon_above = fval_min * (1 + abandon_margin)
+        fval, results, n_evaluations, cached = _refine_cached(
+            counts, lengths, [candidates[num][j]
+                              for num, j in enumerate(choice)],
+            cache=cache, fingerprint=fingerprint, sigma=sigma,
+            verbose=verbose, problem=problem, abandon_above=abandon_above,
+            abandon_after=abandon_after, **fit_parameters)
+        n_fits += 1
+        nfev += n_evaluations
+        n_cached += cached
+        if np.isinf(fval):
+            n_abandoned += 1
+            nfev_abandoned += n_evaluations
+        elif fval_min is None or fval < fval_min:
+            fval_min, choice_min, best_results = fval, choice, results
+
+    n_candidates = int(np.prod(sizes))
+    stats = {"fval": fval_min,
+             "index": int(np.ravel_multi_index(choice_min, sizes)),
+             "n_fits": n_fits, "n_scored": len(scores),
+             "n_pruned": n_pruned,
+             "pruned_fraction": n_pruned / float(n_candidates),
+             "budget_exhausted": budget_exhausted,
+             "completed_fraction": ((n_pruned - n_unsearched + n_fits) /
+                                    float(n_candidates)),
+             "optimal": (not n_pruned and n_fits == n_candidates and
+                         not n_abandoned),
+             "n_abandoned": n_abandoned,
+             "evaluations_saved": _evaluations_saved(
+                 n_fits - n_cached, n_abandoned, nfev, nfev_abandoned),
+             "n_cached": n_cached}
+    return best_results, stats
@@ -0,0 +1,118 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from centurion.optimization import FitProblem
+from centurion.optimization import objective_function
+
+
+MODES = [dict(sparse=True), dict(sparse=False),
+         dict(sparse=True, symmetric=True),
+         dict(sparse=False, symmetric=True),
+         dict(nonzero=False, sparse=False)]
+
+
+def _make_counts(random_state):
+    lengths = np.array([10, 14, 8])
+    n = lengths.sum()
+    counts = random_state.randint(0, 20, size=(n, n)).astype(float)
+    counts[random_state.rand(n, n) > 0.5] = 0
+    counts = counts + counts.T
+    return counts, lengths
+
+
+def _make_parameters(lengths, inside=True):
+    begin = np.concatenate([[0], lengths.cumsum()[:-1]])
+    positions = begin + lengths / 2. + 0.3
+    if not inside:
+        # Below the first bin of the first chromosome, and beyond the last
+        # one of the last chromosome
+        positions[0] = -0.5
+        positions[-1] = lengths.sum() + 0.25
+    return np.concatenate([positions, [30., 2., 1.5]])
+
+
+def _dense_residuals(x, counts, lengths, nonzero=True):
+    n = int(lengths.sum())
+    model = objective_function(x, lengths=lengths,
+                               counts=counts if nonzero else None)
+    return model(*np.indices((n, n))) - counts
+
+
+def test_residuals_dense_model():
+    random_state = np.random.RandomState(seed=42)
+    counts, lengths = _make_counts(random_state)
+    for inside in [True, False]:
+        x = _make_parameters(lengths, inside=inside)
+        for mode in MODES:
+            residuals = _dense_residuals(x, counts, lengths,
+                                         nonzero=mode.get("nonzero", True))
+            expected = (residuals ** 2).sum()
+            problem = FitProblem(counts, lengths, **mode)
+            assert_allclose(problem.sum_of_squares(problem.residuals(x)),
+                            expected, rtol=1e-10)
+            assert_allclose(problem.objective(x), expected, rtol=1e-8)
+            if not mode.get("symmetric", False) and not mode["sparse"]:
+                assert_allclose(problem.residuals(x), residuals.ravel())
+
+
+def test_jacobian_finite_differences():
+    random_state = np.random.RandomState(seed=42)
+    counts, lengths = _make_counts(random_state)
+    for inside in [True, False]:
+        x = _make_parameters(lengths, inside=inside)
+        # Outside of the chromosomes, the residuals include a penalty of
+        # about 1e8, whose rounding errors need a wider step. The penalty is
+        # quadratic: the central differences are exact for it.
+        eps = 1e-6 if inside else 1e-3
+        for mode in MODES:
+            problem = FitProblem(counts, lengths, **mode)
+            jacobian = problem.jacobian(x)
+            assert_array_equal(jacobian.shape,
+                               (len(x), problem.n_residuals))
+            rounding = 4 * np.finfo(float).eps * \
+                np.abs(problem.residuals(x)).max() / eps
+            for i in range(len(x)):
+                step = np.zeros(len(x))
+                step[i] = eps
+                difference = (problem.residuals(x + step) -
+                              problem.residuals(x - step)) / (2 * eps)
+                assert_allclose(
+                    jacobian[i], difference, rtol=1e-5,
+                    atol=1e-5 * np.abs(difference).max() + rounding)
+
+            # The buffer passed as out is filled in place
+            out = problem.jacobian(x, out=problem.jacobian_buffer)
+            assert out is problem.jacobian_buffer
+            assert_allclose(out, jacobian)
+
+
+def test_batch_residuals_jacobian():
+    random_state = np.random.RandomState(seed=42)
+    counts, lengths = _make_counts(random_state)
+    x = _make_parameters(lengths)
+    X = np.array([x, x + 0.1, x - 0.2])
+    for mode in MODES:
+        problem = FitProblem(counts, lengths, **mode)
+        m = len(problem.rows)
+        residuals = problem.residuals_batch(X)
+        jacobian = problem.jacobian_batch(X)
+        for k in range(len(X)):
+            assert_allclose(residuals[k], problem.residuals(X[k])[:m])
+            assert_allclose(jacobian[k], problem.jacobian(X[k])[:, :m])
+
+
+def test_normal_equations():
+    random_state = np.random.RandomState(seed=42)
+    counts, lengths = _make_counts(random_state)
+    x = _make_parameters(lengths)
+    for mode in MODES:
+        problem = FitProblem(counts, lengths, **mode)
+        jacobian = problem.jacobian(x)
+        residuals = problem.residuals(x)
+        # The upper triangle stands for half of the full matrix
+        multiplicity = 2 if mode.get("symmetric", False) else 1
+        hessian, gradient = problem.normal_equations(x)
+        assert_allclose(hessian, multiplicity * jacobian.dot(jacobian.T),
+                        rtol=1e-8, atol=1e-8)
+        assert_allclose(gradient, multiplicity * jacobian.dot(residuals),
+                        rtol=1e-8, atol=1e-8)
@@ -0,0 +1,198 @@
+import numpy as np
+from numpy.testing import assert_array_equal
+from scipy import ndimage
+
+from centurion.prelocalization_ import find_centromeres_candidates
+from centurion.prelocalization_ import filter_centromeres_candidates
+from centurion.prelocalization_ import optimize_centromeres
+from centurion.prelocalization_ import _detect_peaks
+
+
+def _make_counts(random_state, lengths):
+    n = lengths.sum()
+    counts = random_state.randint(0, 50, size=(n, n)).astype(float)
+    counts = counts + counts.T
+    return counts
+
+
+def _make_centromere_counts(random_state, lengths, positions):
+    # Gaussian centromere signal, with noise
+    n = lengths.sum()
+    chromosomes = np.repeat(np.arange(len(lengths)), lengths)
+    g = np.exp(- (positions[chromosomes] - np.arange(n)) ** 2 / 8.)
+    counts = 100 * np.outer(g, g) + 5 + random_state.rand(n, n)
+    return counts + counts.T
+
+
+def _detect_peaks_loop(sum_trans):
+    # Peak detection of a marginal, as before the vectorised _detect_peaks
+    peaks = []
+    scores = []
+    der = sum_trans[1:] - sum_trans[:-1]
+
+    if len(der) == 0:
+        return peaks
+
+    if der[0] < 0:
+        peaks.append(0.5)
+        scores.append(sum_trans[0])
+
+    for i in range(1, len(der)):
+        if np.sign(der[i]) < 0 and (np.sign(der[i - 1]) > 0) and \
+           sum_trans[i] > np.median(sum_trans):
+            peaks.append(i + 0.5)
+            scores.append(- max(sum_trans[i - 1], sum_trans[i]) / 2)
+
+    if len(scores) > 1:
+        scores = np.array(scores)
+        indx = scores.argsort()
+        peaks = [peaks[i] for i in indx]
+    return peaks
+
+
+def _detect_peaks_2d(counts, lengths, sigma):
+    # Peak detection on the rows of a chromosome smoothed by a 2D gaussian
+    # filter, as before the trans marginal
+    begin2, end2 = 0, 0
+    for l2 in lengths:
+        end2 += l2
+        subcounts = ndimage.gaussian_filter(
+            counts[:, begin2:end2], sigma)
+        counts[:, begin2:end2] = subcounts
+        begin2 = end2
+    return _detect_peaks_loop(counts.sum(axis=1))
+
+
+def _find_centromeres_candidates_2d(counts, lengths, n_candidate=3,
+                                    min_sigma=1):
+    begin, end = 0, 0
+    centromeres_call = []
+    sigmas = []
+    lencum = np.concatenate([[0], lengths.cumsum().astype(int)])
+
+    counts = counts.copy()
+    counts[:, lencum[:-1]] = 0
+    counts[lencum[:-1]] = 0
+    counts[:, lencum[1:] - 1] = 0
+    counts[lencum[1:] - 1] = 0
+
+    for length in lengths.astype(int):
+        end += length
+        sigma = 1
+        max_sigma = length
+        peaks = _detect_peaks_2d(counts[begin:end].copy(), lengths, sigma)
+        while (len(peaks) > n_candidate) and (sigma < max_sigma):
+            sigma += 1
+            peaks = _detect_peaks_2d(counts[begin:end].copy(), lengths,
+                                     sigma)
+
+        while len(peaks) < n_candidate and sigma >= min_sigma:
+            sigma -= 0.5
+            peaks = _detect_peaks_2d(counts[begin:end].copy(), lengths,
+                                     sigma)
+
+        if len(peaks) == 0:
+            peaks = [length / 2 + begin]
+        else:
+            peaks = [peak + begin for peak in peaks]
+        centromeres_call.append(peaks)
+        sigmas.append(sigma)
+        begin = end
+    return centromeres_call, sigmas
+
+
+def test_find_centromeres_candidates_2d_filter():
+    lengths = np.array([30, 45, 25])
+    for seed in range(5):
+        random_state = np.random.RandomState(seed=seed)
+        counts = _make_counts(random_state, lengths)
+        # min_sigma 0 goes down to sigma 0 and -0.5, which don't smooth
+        for n_candidate, min_sigma in [(1, 1), (3, 1), (6, 1), (8, 0),
+                                       (20, 0)]:
+            candidates, sigmas = find_centromeres_candidates(
+                counts, lengths, n_candidate=n_candidate,
+                min_sigma=min_sigma, return_sigma=True)
+            true_candidates, true_sigmas = _find_centromeres_candidates_2d(
+                counts, lengths, n_candidate=n_candidate,
+                min_sigma=min_sigma)
+            assert_array_equal(sigmas, true_sigmas)
+            assert len(candidates) == len(true_candidates)
+            for peaks, true_peaks in zip(candidates, true_candidates):
+                assert_array_equal(peaks, true_peaks)
+
+
+def test_detect_peaks():
+    random_state = np.random.RandomState(seed=42)
+    for length in [0, 1, 2, 3]:
+        sum_trans = random_state.rand(length)
+        assert_array_equal(_detect_peaks(sum_trans),
+                           _detect_peaks_loop(sum_trans))
+    for _ in range(3000):
+        length = random_state.randint(4, 60)
+        if random_state.rand() < 0.5:
+            # Few distinct values: plateaus, and peaks of equal height
+            sum_trans = random_state.randint(0, 4, size=length).astype(float)
+        else:
+            sum_trans = random_state.rand(length)
+        assert_array_equal(_detect_peaks(sum_trans),
+                           _detect_peaks_loop(sum_trans))
+
+
+def test_filter_centromeres_candidates_njobs():
+    random_state = np.random.RandomState(seed=42)
+    lengths = np.array([20, 25, 15])
+    counts = _make_centromere_counts(random_state, lengths,
+                                     np.array([8.3, 32.6, 51.2]))
+    # Starting away from the centromeres, some alternatives are kept and
+    # others aren't
+    candidates = [[3.5, 8.5, 15.5], [24.5, 33.5, 40.5], [45.5, 51.5, 56.5]]
+    kept_candidates = filter_centromeres_candidates(counts, lengths,
+                                                    candidates)
+    assert [len(kept) for kept in kept_candidates] == [2, 1, 2]
+    assert kept_candidates == filter_centromeres_candidates(
+        counts, lengths, candidates, njobs=2)
+
+
+def test_optimize_centromeres_njobs():
+    random_state = np.random.RandomState(seed=42)
+    lengths = np.array([20, 25, 15])
+    counts = _make_centromere_counts(random_state, lengths,
+                                     np.array([8.3, 32.6, 51.2]))
+    candidates = [[3.5, 8.5], [33.5, 40.5], [45.5, 51.5]]
+    for batch_size in [None, 2]:
+        results, stats = optimize_centromeres(
+            counts, lengths, candidates, batch_size=batch_size,
+            return_stats=True)
+        parallel_results, parallel_stats = optimize_centromeres(
+            counts, lengths, candidates, batch_size=batch_size, njobs=2,
+            return_stats=True)
+        assert_array_equal(results, parallel_results)
+        assert stats["index"] == parallel_stats["index"]
+        assert stats["n_fits"] == parallel_stats["n_fits"] == 8
+
+    # Every combination is the same fit: the ties are broken by the
+    # enumeration order, whatever the chunks
+    candidates = [[8.5, 8.5], [33.5, 33.5], [51.5, 51.5]]
+    for njobs in [1, 2]:
+        _, stats = optimize_centromeres(counts, lengths, candidates,
+                                        njobs=njobs, return_stats=True)
+        assert stats["index"] == 0
+
+
+def test_find_centromeres_candidates_bisection_sigma_range():
+    random_state = np.random.RandomState(seed=42)
+    lengths = np.array([2, 30])
+    counts = _make_counts(random_state, lengths)
+    # The default max_sigma of the first chromosome, its length, is below
+    # min_sigma
+    candidates, sigmas = find_centromeres_candidates(
+        counts, lengths, min_sigma=3, search="bisection", return_sigma=True)
+    assert sigmas[0] == 2
+    assert len(candidates) == 2
+    try:
+        find_centromeres_candidates(counts, lengths, min_sigma=3,
+                                    max_sigma=2, search="bisection")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("min_sigma above max_sigma should raise")
@@ -49,3 +49,29 @@ def downsample_resolution(counts, lengths, coefficient=2):
         begin_i = end_i
         target_begin_i = target_end_i
     return target_counts, target_lengths
+
+
+def mask_intra_counts(counts, lengths):
+    """
+    Sets the intra-chromosomal contact counts to 0, in place
+
+    Unlike indexing counts with iced.utils.get_intra_mask, this doesn't
+    build an n x n mask.
+
+    Parameters
+    ----------
+    counts : ndarray (N, N)
+        contact counts matrix
+
+    lengths : ndarray (L, )
+        chromosomes lengths
+
+    Returns
+    -------
+    counts : ndarray (N, N)
+    """
+    begin = 0
+    for end in np.cumsum(lengths):
+        counts[begin:end, begin:end] = 0
+        begin = end
+    return counts